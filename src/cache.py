@@ -0,0 +1,58 @@
+# In-process caches for the server.
+
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    # A least-recently-used cache bounded by size rather than by number of entries.  Each entry is put with a size in
+    # bytes (it's up to the caller what that means, usually the length of the string the value was parsed from), and
+    # once the total goes over max_bytes the least recently used entries are evicted.
+    # A max_bytes of 0 turns the cache off: nothing is stored and every get is a miss.
+    # If ttl (in seconds) is given, entries also expire that long after they were put.
+    # Everything here is synchronous, so it's safe to share between coroutines on one event loop.
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (value, size, expiry time or None)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if self.max_bytes == 0:
+            # A disabled cache can't hit, so counting misses would only make the stats look bad
+            return default
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+            self.bytes -= self.entries.pop(key)[1]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[1]
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self.entries[key] = (value, size, expires)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses}
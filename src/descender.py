@@ -1,11 +1,15 @@
 # Convenience class for loading biolink and coming up with all the descendants of pq and
 # types.
 
+import asyncio
+import time
+
 from bmt import Toolkit
 import jsonpickle
+import msgpack
 from collections import defaultdict
 
-from src.keymaster import create_pq
+from src.keymaster import create_pq, read_partial_pattern_array, LIST_PATTERNS
 
 class Descender:
     def __init__(self,rc = None):
@@ -13,20 +17,15 @@ class Descender:
         When we load from redis, we also pull in the s and o partial patterns which are used to filter at q time.
         If you are creating descender with an rc, you also need to call setup on it asynchronously."""
         if rc is not None:
-            #db = rc.r[7]
-            #self.pq_to_descendants = jsonpickle.decode(db.get("pq_to_descendants"))
-            self.pq_to_descendants = None
-            #self.type_to_descendants = jsonpickle.decode(db.get("type_to_descendants"))
-            self.type_to_descendants = None
-            #self.predicate_is_symmetric = jsonpickle.decode(db.get("predicate_symmetries"))
-            self.predicate_is_symmetric = None
-            #self.s_partial_patterns = jsonpickle.decode(db.get("s_partial_patterns"))
-            self.s_partial_patterns = None
-            #self.o_partial_patterns = jsonpickle.decode(db.get("o_partial_patterns"))
-            self.o_partial_patterns = None
-            self.pq_to_descendant_int_ids = None
             #Need to hang onto this b/c we are going to lazy load pq_to_descendant_int_ids.  Doing it here is a pain from an async perspective
             self.rc = rc
+            # The load generation that everything below came from
+            self.generation = None
+            # How long warm() took, if it has been called
+            self.warm_seconds = None
+            # Counts the resets, so that a load can tell if there has been one since it started (see shared_load)
+            self.resets = 0
+            self.reset()
         else:
             self.t = Toolkit()
             self.type_to_descendants = self.create_type_to_descendants()
@@ -34,20 +33,115 @@ class Descender:
             self.predicate_is_symmetric = self.create_is_symmetric()
             self.deeptypescache = {}
 
+    def reset(self):
+        """Forget everything that was pulled from redis (or built from it), so that it is lazily loaded again."""
+        self.pq_to_descendants = None
+        self.type_to_descendants = None
+        self.predicate_is_symmetric = None
+        self.s_partial_patterns = None
+        self.o_partial_patterns = None
+        self.pq_to_descendant_int_ids = None
+        self.type_int_ids = None
+        self.pattern_format = None
+        self.metadata_version = None
+        # (pq, output_type, input_is_subject) -> [(pq_int_id, type_int_id)], see get_expansion_plan
+        self.expansion_plans = {}
+        # Loads that are in flight, see shared_load.  Ones from before this reset finish, but aren't kept.
+        self.loading = {}
+        self.resets += 1
+
+    async def shared_load(self, key, load):
+        """Run load() for key, or if it's already running, wait for that instead, so that concurrent callers share one
+        load.  Returns (value, keep): keep is False if there has been a reset since the load started, in which case the
+        value may be from before a load generation and mustn't be stored."""
+        if key not in self.loading:
+            self.loading[key] = (self.resets, asyncio.ensure_future(load()))
+        resets, task = self.loading[key]
+        try:
+            # Shielded, so that one caller going away doesn't cancel the load for the others
+            value = await asyncio.shield(task)
+        finally:
+            if task.done() and self.loading.get(key, (None, None))[1] is task:
+                del self.loading[key]
+        return value, resets == self.resets
+
+    async def lazy(self, name, load):
+        """Return the attribute name, first loading it with load() (through shared_load) if it's None."""
+        value = getattr(self, name)
+        if value is None:
+            value, keep = await self.shared_load(name, load)
+            if keep:
+                setattr(self, name, value)
+        return value
+
+    async def check_generation(self):
+        """If there has been a load since we pulled our metadata, drop it so that it is pulled again."""
+        generation = await self.rc.get_generation()
+        if generation != self.generation:
+            if self.generation is not None:
+                self.reset()
+            self.generation = generation
+
+    async def load_metadata(self, name):
+        """Pull one of the metadata elements that load_redis.write_metadata wrote to db7, in whichever format it was
+        written."""
+        async def read_version():
+            version = await self.rc.r[7].get(self.rc.key(7, "metadata_version"))
+            # Databases loaded before there was a version are all jsonpickle
+            return 1 if version is None else int(version)
+        metadata_version = await self.lazy("metadata_version", read_version)
+        value = await self.rc.r[7].get(self.rc.key(7, name))
+        # The partial patterns are indexed as {type_int_id: {pq_int_ids}}, whatever the format
+        if metadata_version == 1:
+            value = jsonpickle.decode(value)
+            if name == "s_partial_patterns":
+                # "pq_int_id,type_int_id"
+                return index_partial_patterns((int(t), int(pq)) for pq, t in (p.split(",") for p in value))
+            if name == "o_partial_patterns":
+                # "type_int_id,-pq_int_id"
+                return index_partial_patterns((int(t), -int(pq)) for t, pq in (p.split(",") for p in value))
+            return value
+        if name == "s_partial_patterns":
+            return index_partial_patterns((t, pq) for pq, t in read_partial_pattern_array(value).tolist())
+        if name == "o_partial_patterns":
+            return index_partial_patterns(read_partial_pattern_array(value).tolist())
+        return msgpack.unpackb(value)
+
+    async def warm(self):
+        """Load everything that is otherwise lazily loaded by the first queries, so that they aren't slow.  This is
+        meant to be called at server startup.  Returns how long it took, in seconds, or None if there is nothing in
+        db7 to load yet (a server started before the first load), in which case it's left to the first query."""
+        start = time.perf_counter()
+        if not await self.rc.r[7].exists(self.rc.key(7, "s_partial_patterns")):
+            print("No metadata in redis yet, so the first query will load it")
+            return None
+        # None of these depend on each other, so they can all be in flight at once.  They go through lazy(), like the
+        # queries' own loads, so a query that comes in meanwhile waits for the same load, and a reset part way through
+        # means nothing from before it is kept.  The int id maps load the descendant maps too.
+        await asyncio.gather(self.get_s_partial_patterns(), self.get_o_partial_patterns(), self.get_pattern_format(),
+                             self.get_predicate_symmetries(), self.get_pq_to_descendant_int_ids(),
+                             self.get_type_int_ids())
+        self.warm_seconds = time.perf_counter() - start
+        return self.warm_seconds
+
     async def get_s_partial_patterns(self):
-        if self.s_partial_patterns is None:
-            self.s_partial_patterns = jsonpickle.decode(await self.rc.r[7].get("s_partial_patterns"))
-        return self.s_partial_patterns
+        return await self.lazy("s_partial_patterns", lambda: self.load_metadata("s_partial_patterns"))
 
     async def get_o_partial_patterns(self):
-        if self.o_partial_patterns is None:
-            self.o_partial_patterns = jsonpickle.decode(await self.rc.r[7].get("o_partial_patterns"))
-        return self.o_partial_patterns
+        return await self.lazy("o_partial_patterns", lambda: self.load_metadata("o_partial_patterns"))
+
+    async def get_pattern_format(self):
+        async def read_pattern_format():
+            # Databases loaded before there was a choice only have list patterns
+            pattern_format = await self.rc.r[7].get(self.rc.key(7, "pattern_format"))
+            return LIST_PATTERNS if pattern_format is None else pattern_format.decode()
+        return await self.lazy("pattern_format", read_pattern_format)
+
+    async def get_predicate_symmetries(self):
+        return await self.lazy("predicate_is_symmetric", lambda: self.load_metadata("predicate_symmetries"))
 
     async def is_symmetric(self, predicate):
-        if self.predicate_is_symmetric is None:
-            self.predicate_is_symmetric = jsonpickle.decode(await self.rc.r[7].get("predicate_symmetries"))
-        return self.predicate_is_symmetric[predicate]
+        return (await self.get_predicate_symmetries())[predicate]
     def create_is_symmetric(self):
         # Create a dictionary from predicate to whether it is symmetric
         # The symmetric nature of an edge is completely determined by the predicate.
@@ -119,9 +213,7 @@ class Descender:
                     pq_to_descendants[k].update(decs[original_pk])
         return pq_to_descendants
     async def get_type_descendants(self, t):
-        if self.type_to_descendants is None:
-            self.type_to_descendants = jsonpickle.decode(await self.rc.r[7].get("type_to_descendants"))
-        return self.type_to_descendants[t]
+        return (await self.lazy("type_to_descendants", lambda: self.load_metadata("type_to_descendants")))[t]
     #async def get_pq_descendants(self, pq):
     #    try:
     #        if self.pq_to_descendants is None:
@@ -133,15 +225,13 @@ class Descender:
         # Create a dictionary from pq to all of its descendant integer ids
         # First, pull the integer id for every pq
         # Lazy create pq_to_descendants by puling it from redis
-        if self.pq_to_descendants is None:
-            pkl = await self.rc.r[7].get("pq_to_descendants")
-            self.pq_to_descendants = jsonpickle.decode(pkl)
-        pql = list(self.pq_to_descendants.keys())
+        pq_to_descendants = await self.lazy("pq_to_descendants", lambda: self.load_metadata("pq_to_descendants"))
+        pql = list(pq_to_descendants.keys())
         pq_int_ids = await rc.pipeline_gets(3, pql, True)
         # now convert pq_to_descendants into int id values
         pq_to_descendant_int_ids = {}
-        for pq in self.pq_to_descendants:
-            descendants = self.pq_to_descendants[pq]
+        for pq in pq_to_descendants:
+            descendants = pq_to_descendants[pq]
             pq_to_descendant_int_ids[pq] = set()
             for desc in descendants:
                 # Not every possible descendant is in the database, and the point here is to filter it down to the ones that are.
@@ -151,10 +241,49 @@ class Descender:
                     # This is totally expected
                     pass
         return pq_to_descendant_int_ids
+    async def get_pq_to_descendant_int_ids(self):
+        return await self.lazy("pq_to_descendant_int_ids", lambda: self.create_pq_to_descendant_int_ids(self.rc))
     async def get_pq_descendant_int_ids(self, pq):
-        if self.pq_to_descendant_int_ids is None:
-            self.pq_to_descendant_int_ids = await self.create_pq_to_descendant_int_ids(self.rc)
-        return self.pq_to_descendant_int_ids[pq]
+        return (await self.get_pq_to_descendant_int_ids())[pq]
+    async def create_type_int_ids(self):
+        # Pull the category int id (db2) for every type that we know about, in one go.  Types that don't have any
+        # nodes in the db don't have an id.
+        type_to_descendants = await self.lazy("type_to_descendants", lambda: self.load_metadata("type_to_descendants"))
+        return await self.rc.pipeline_gets(2, list(type_to_descendants.keys()), True)
+    async def get_type_int_ids(self):
+        return await self.lazy("type_int_ids", self.create_type_int_ids)
+    async def get_type_descendant_int_ids(self, t):
+        # The int ids of a type and all of its descendants, leaving out the ones that aren't in the db
+        type_int_ids = await self.get_type_int_ids()
+        return [type_int_ids[d] for d in await self.get_type_descendants(t) if d in type_int_ids]
+    async def get_expansion_plan(self, pq, output_type, input_is_subject):
+        """Return the (pq_int_id, type_int_id) pairs that a query for pq and output_type has to look at: the
+        descendants of the pq crossed with the descendants of the type, filtered down to the ones that actually occur in
+        the db with the input on the given side.  A query only has to cross these with its input ids.
+        Plans are built the first time they are asked for, and kept until the next load generation.  Concurrent
+        callers for the same plan share one build."""
+        await self.check_generation()
+        key = (pq, output_type, input_is_subject)
+        if key in self.expansion_plans:
+            return self.expansion_plans[key]
+        plan, keep = await self.shared_load(("plan",) + key,
+                                            lambda: self.build_expansion_plan(pq, output_type, input_is_subject))
+        if keep:
+            self.expansion_plans[key] = plan
+        return plan
+    async def build_expansion_plan(self, pq, output_type, input_is_subject):
+        # The partial patterns are {type_int_id: {pq_int_ids}}, only holding the combinations that are actually in the db.
+        # None of these depend on each other, so if any have to come from redis, they come at the same time.
+        pq_int_ids, type_int_ids, partial_patterns = await asyncio.gather(
+            self.get_pq_descendant_int_ids(pq),
+            self.get_type_descendant_int_ids(output_type),
+            self.get_s_partial_patterns() if input_is_subject else self.get_o_partial_patterns())
+        plan = []
+        for type_int_id in type_int_ids:
+            # Sorted, so that the plan (and so the order of a query's results, see query_redis.Page) is always the same
+            for pq_int_id in sorted(pq_int_ids.intersection(partial_patterns.get(type_int_id, ()))):
+                plan.append((pq_int_id, type_int_id))
+        return plan
     def get_deepest_types(self, typelist):
         """Given a list of types, examine self.type_to_descendants and return a list of the types
         from typelist that do not have a descendant in the list"""
@@ -175,6 +304,14 @@ class Descender:
         self.deeptypescache[fs] = deepest_types
         return deepest_types
 
+def index_partial_patterns(pairs):
+    # Given (type_int_id, pq_int_id) pairs, return a dictionary from each type_int_id to the set of pq_int_ids that
+    # occur with it.  This lets a query find the pqs it needs for a type with one set intersection.
+    index = defaultdict(set)
+    for type_int_id, pq_int_id in pairs:
+        index[type_int_id].add(pq_int_id)
+    return dict(index)
+
 def add_all_decs(edge, directions, aspects, decs):
     pq = create_pq(edge)
     decs[pq].add(pq) # We're going to get the pq by looking at the decendent list so we want pq itself
@@ -1,4 +1,9 @@
+import base64
+import hashlib
 import json
+import struct
+
+import numpy as np
 
 def create_pq(record):
     # Given an edge json record, create a string that represents the predicate and qualifiers
@@ -30,5 +35,110 @@ def create_trapi_pq(trapi_edge):
             new_edge[qualifier["qualifier_type_id"]] = qualifier["qualifier_value"]
     return create_pq(new_edge)
 
+def create_query_graph_key(query_graph):
+    # Given a one-hop TRAPI query graph, create the string that the response cache keys on.  It's the whole query graph,
+    # not just the question it asks: the response echoes the query graph back, and the order of the ids decides the
+    # order of the results, so two graphs only get the same answer if they're the same graph.
+    return json.dumps(query_graph, sort_keys=True)
+
+def create_cursor(generation, query_graph, position):
+    # Create the opaque cursor that /query hands back for the next page of a query: base64 json of the load generation,
+    # a hash of the query graph, and the (pattern, offset) that the page starts at (see query_redis.Page).  The hash is
+    # of create_query_graph_key, the same string the response cache keys on, so a cached page only ever carries a
+    # cursor that its own query graph will accept.
+    return base64.urlsafe_b64encode(json.dumps([generation_string(generation), hash_query_graph(query_graph),
+                                                *position]).encode()).decode()
+
+def read_cursor(cursor, generation, query_graph):
+    # Given a cursor from create_cursor, return the (pattern, offset) it points to.  It has to be from the same query
+    # graph, and from the database as it is now: after a load, the same position means something else.
+    try:
+        cursor_generation, query_hash, pattern, offset = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        position = (int(pattern), int(offset))
+    except (ValueError, TypeError):
+        raise ValueError("Not a valid cursor")
+    # A negative position would count back from the end of the patterns (see query_redis.plan_page)
+    if position[0] < 0 or position[1] < 0:
+        raise ValueError("Not a valid cursor")
+    if query_hash != hash_query_graph(query_graph):
+        raise ValueError("The cursor is from a different query")
+    if cursor_generation != generation_string(generation):
+        raise ValueError("The database has been reloaded since the cursor was made.  Start the query again.")
+    return position
+
+def hash_query_graph(query_graph):
+    return hashlib.blake2b(create_query_graph_key(query_graph).encode(), digest_size=8).hexdigest()
+
+def generation_string(generation):
+    # The generation stamp as redis returns it, bytes or None for a database from before there were stamps
+    return "" if generation is None else generation.decode()
+
 def create_query_pattern(s_int, pq_int, o_int):
     return f"{s_int},{pq_int},{o_int}"
+
+
+# Storage layouts.  In the multidb layout each logical db (0-7) is its own redis db.  In the keyspace layout everything
+# lives in redis db0 and each key is prefixed with its logical db, so commands for different logical dbs can share a
+# single pipeline (and the data can live somewhere that only has db0, like Redis Cluster).
+MULTIDB = "multidb"
+KEYSPACE = "keyspace"
+LAYOUTS = [MULTIDB, KEYSPACE]
+
+# Blue/green loading.  A redis server holds two copies of the database, in slots 0 and 1.  Logical db d of slot s is
+# stored as db d + 8 * s: in the multidb layout that's redis db 0-7 or 8-15, and in the keyspace layout it's the key
+# prefix.  The slot that the server should read is in CURRENT_SLOT_KEY, in redis db 0 with no prefix, so the loader
+# can fill the other slot while the server is using this one and then flip over with one SET.  If it isn't set, the
+# current slot is 0.
+SLOTS = 2
+CURRENT_SLOT_KEY = "current_slot"
+
+def slot_db(slot, db):
+    # Given a slot and a logical db, return the db that it is stored as
+    return db + 8 * slot
+
+def create_layout_key(layout, db, key):
+    # Given a layout, a db (from slot_db) and a key in that db, create the key that is actually stored in redis
+    if layout == KEYSPACE:
+        return f"{db}:{key}"
+    return key
+
+
+# Formats for the query patterns in db5.  In the list format a pattern is a redis list of alternating edge and node int
+# ids as decimal strings.  In the packed format it is a single string of little-endian uint32 (edge_id, node_id) pairs,
+# which is much smaller in redis and can be decoded in one call with numpy.
+LIST_PATTERNS = "list"
+PACKED_PATTERNS = "packed"
+PATTERN_FORMATS = [LIST_PATTERNS, PACKED_PATTERNS]
+PACKED_DTYPE = "<u4"
+
+def create_packed_pattern_entry(edge_id, node_id):
+    # Create the bytes for one (edge_id, node_id) pair of a packed query pattern
+    return struct.pack("<II", edge_id, node_id)
+
+
+# Formats for the nodes in db1.  In the json format a node is the fixed KGX node as json, still with its id.  In the
+# fragment format it is a ready-made member of the TRAPI knowledge_graph nodes object: the json curie, a colon, and the
+# node without its id.  Fragments can be spliced into a response without being parsed, and readers can tell them apart
+# because a fragment starts with a quote rather than a brace.
+JSON_NODES = "json"
+FRAGMENT_NODES = "fragment"
+NODE_FORMATS = [JSON_NODES, FRAGMENT_NODES]
+
+def create_node_fragment(node):
+    # Given a fixed node (with its id), create the fragment format string.  The node is not changed.
+    return json.dumps(node["id"]) + ":" + json.dumps({k: v for k, v in node.items() if k != "id"})
+
+
+# The format of the metadata in db7.  Version 1 was jsonpickle throughout.  Version 2 is msgpack, except for the
+# partial patterns, which are sorted int32 pairs: (pq_int_id, type_int_id) for subject patterns and
+# (type_int_id, pq_int_id) for object patterns.
+METADATA_VERSION = 2
+PARTIAL_PATTERN_DTYPE = "<i4"
+
+def create_partial_pattern_array(partial_patterns):
+    # Given a set of (int, int) partial patterns, create the bytes that are stored for them in db7
+    return np.array(sorted(partial_patterns), dtype=PARTIAL_PATTERN_DTYPE).reshape(-1, 2).tobytes()
+
+def read_partial_pattern_array(value):
+    # Inverse of create_partial_pattern_array, returns an (n, 2) array
+    return np.frombuffer(value, dtype=PARTIAL_PATTERN_DTYPE).reshape(-1, 2)
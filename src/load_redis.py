@@ -1,14 +1,24 @@
 # Given KGX jsonl files, load them into Redis
 # Usage: python load_redis.py <path_to_kgx_jsonl_files> <redis_host> <redis_port> <redis_password>
+#    or: python load_redis.py <path_to_kgx_jsonl_files> --export <path>, and later redis-cli --pipe < <path>
 
 import argparse
 import json
-import jsonpickle
+import multiprocessing
+import time
+import uuid
 from collections import defaultdict
+from itertools import islice
 
-from redis_connector import RedisConnection
-from keymaster import create_pq, create_query_pattern
+import msgpack
+import orjson
+
+from redis_connector import RedisLoadConnection, RedisShardedLoadConnection, RedisExportConnection
+from keymaster import create_pq, create_query_pattern, create_packed_pattern_entry, create_partial_pattern_array, \
+    read_partial_pattern_array, create_node_fragment, MULTIDB, LAYOUTS, LIST_PATTERNS, PACKED_PATTERNS, \
+    PATTERN_FORMATS, METADATA_VERSION, JSON_NODES, FRAGMENT_NODES, NODE_FORMATS, SLOTS, CURRENT_SLOT_KEY
 from descender import Descender
+from node_map import CurieMap, CategoryColumn, ChainedMap, SubclassIndex
 
 def fixnode(node):
     # The jsonl nodes don't validate TRAPI.   There are several problems:
@@ -50,121 +60,403 @@ def fixedge(edge):
     return new_edge
 
 
-def load_nodes(nodepath, descender, host, port, password):
+# How many lines of a jsonl file to prepare at a time.  Each chunk is one task for the parallel loader's processes.
+LOAD_CHUNK_SIZE = 10000
+
+# How many edges' worth of values to gather up for each pattern before pushing them (see write_pushes).  The bigger
+# this is, the fewer commands, but the more memory the loader uses.
+PATTERN_WINDOW = 100000
+
+# The most subclasses that one node gets in db6 (see write_subclasses)
+SUBCLASS_CAP = 10000
+
+# What prepare_nodes and prepare_edges need besides the lines, set by init_worker.  In the parallel loader these are
+# set once in each worker process (and with fork, the big node maps aren't even copied).
+worker_state = {}
+
+def init_worker(state):
+    worker_state.clear()
+    worker_state.update(state)
+
+def read_chunks(path, size=LOAD_CHUNK_SIZE):
+    with open(path, "rb") as f:
+        while True:
+            chunk = list(islice(f, size))
+            if not chunk:
+                return
+            yield chunk
+
+def prepared_records(path, prepare, state, processes=0):
+    # Run prepare over the chunks of a jsonl file, and yield the prepared records in file order.  With processes=0
+    # everything happens in this process; otherwise the chunks are prepared by a pool of that many processes, while
+    # this one writes.
+    if processes == 0:
+        init_worker(state)
+        for chunk in read_chunks(path):
+            yield from prepare(chunk)
+        return
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(state,)) as pool:
+        for prepared in pool.imap(prepare, read_chunks(path)):
+            yield from prepared
+
+def prepare_nodes(lines):
+    # Parse and fix node lines, returning (node id, deepest categories, the string to store in db1) for each
+    descender = worker_state["descender"]
+    node_format = worker_state["node_format"]
+    prepared = []
+    for line in lines:
+        record = orjson.loads(line)
+        record_id = record['id']
+        fixnode(record)
+        # We need to look for conflated things like gene/protein. It will have multiple categories
+        categories = descender.get_deepest_types(record['categories'])
+        if node_format == FRAGMENT_NODES:
+            prepared.append((record_id, categories, create_node_fragment(record)))
+        else:
+            prepared.append((record_id, categories, json.dumps(record)))
+    return prepared
+
+def prepare_edges(lines):
+    # Parse and fix edge lines, returning (pq, subject int id, object int id, subject category ids, object category
+    # ids, the string to store in db4) for each.  For subclass edges, only the int ids are filled in.
+    nodeid_to_categories = worker_state["nodeid_to_categories"]
+    nodeid_to_intnodeid = worker_state["nodeid_to_intnodeid"]
+    prepared = []
+    for line in lines:
+        record = orjson.loads(line)
+        s_int = nodeid_to_intnodeid[record['subject']]
+        o_int = nodeid_to_intnodeid[record['object']]
+        if record["predicate"] == "biolink:subclass_of":
+            prepared.append((None, s_int, o_int, None, None, None))
+        else:
+            fixed_record = fixedge(record)
+            prepared.append((create_pq(fixed_record), s_int, o_int, nodeid_to_categories.get(s_int, []),
+                             nodeid_to_categories.get(o_int, []), json.dumps(fixed_record)))
+    return prepared
+
+def load_connection(host, port, password, layout, connections, export=None, slot=0):
+    if export is not None:
+        return RedisExportConnection(export, layout, slot)
+    if connections > 1:
+        return RedisShardedLoadConnection(host, port, password, layout, connections, slot)
+    return RedisLoadConnection(host, port, password, layout, slot)
+
+def report(kind, count, start):
+    print(kind, count, f"({count / max(time.perf_counter() - start, 1e-9):.0f} records/sec)")
+
+# For incremental loading, the state of the database is read back from redis.  Only one loader should be writing to a
+# database at a time.
+
+def read_counter(rc, name):
+    # Read back last_node_id or last_edge_id from db7
+    value = rc.r[7].get(rc.key(7, name))
+    if value is None:
+        raise ValueError(f"There is no {name} in redis, so it can't be appended to.  It needs a full load.")
+    return int(value)
+
+def read_ids(rc, db):
+    # Read back a whole map of name -> int id: the categories in db2 or the pqs in db3
+    prefix = len(rc.key(db, ""))
+    keys = list(rc.r[db].scan_iter(match=rc.key(db, "*"), count=LOAD_CHUNK_SIZE))
+    ids = {}
+    for start in range(0, len(keys), LOAD_CHUNK_SIZE):
+        chunk = keys[start:start + LOAD_CHUNK_SIZE]
+        for key, value in zip(chunk, rc.r[db].mget(chunk)):
+            ids[key[prefix:].decode()] = int(value)
+    return ids
+
+def skip_existing_nodes(rc, records, skipped):
+    # Pass through the prepared node records whose ids aren't already in db0, adding the ones that are to skipped.
+    # Nodes that are already there keep their int ids and records.
+    while True:
+        chunk = list(islice(records, LOAD_CHUNK_SIZE))
+        if not chunk:
+            return
+        existing = rc.r[0].mget([rc.key(0, record[0]) for record in chunk])
+        for record, int_id in zip(chunk, existing):
+            if int_id is None:
+                yield record
+            else:
+                skipped.add(record[0])
+
+def node_categories(node_string):
+    # The categories of a node from db1, in either node format
+    if node_string[:1] == b'"':
+        (node,) = orjson.loads(b"{" + node_string + b"}").values()
+    else:
+        node = orjson.loads(node_string)
+    return node["categories"]
+
+def read_subclasses(rc):
+    # Read back all of db6, int node id -> list of subclass int node ids
+    prefix = len(rc.key(6, ""))
+    keys = list(rc.r[6].scan_iter(match=rc.key(6, "*"), count=LOAD_CHUNK_SIZE))
+    subclasses = {}
+    for start in range(0, len(keys), LOAD_CHUNK_SIZE):
+        chunk = keys[start:start + LOAD_CHUNK_SIZE]
+        pipeline = rc.r[6].pipeline()
+        for key in chunk:
+            pipeline.lrange(key, 0, -1)
+        for key, values in zip(chunk, pipeline.execute()):
+            subclasses[int(key[prefix:])] = [int(v) for v in values]
+    return subclasses
+
+def read_existing_nodes(edgepath, nodeid_to_intnodeid, descender, rc):
+    # For an incremental load, find the nodes that the new edges use that were loaded before, and return their
+    # curie -> int id and int id -> category ids, read back from redis.  Curies that aren't in redis are left out.
+    curies = set()
+    for chunk in read_chunks(edgepath):
+        for line in chunk:
+            record = orjson.loads(line)
+            for curie in (record['subject'], record['object']):
+                try:
+                    nodeid_to_intnodeid[curie]
+                except KeyError:
+                    curies.add(curie)
+    categories_to_id = read_ids(rc, 2)
+    curie_to_intnodeid = {}
+    intnodeid_to_categories = {}
+    curies = list(curies)
+    for start in range(0, len(curies), LOAD_CHUNK_SIZE):
+        chunk = curies[start:start + LOAD_CHUNK_SIZE]
+        found = [(curie, int(int_id)) for curie, int_id in zip(chunk, rc.r[0].mget([rc.key(0, c) for c in chunk]))
+                 if int_id is not None]
+        if not found:
+            continue
+        node_strings = rc.r[1].mget([rc.key(1, int_id) for _, int_id in found])
+        for (curie, int_id), node_string in zip(found, node_strings):
+            curie_to_intnodeid[curie] = int_id
+            categories = descender.get_deepest_types(node_categories(node_string))
+            intnodeid_to_categories[int_id] = [categories_to_id[category] for category in categories]
+    return curie_to_intnodeid, intnodeid_to_categories
+
+
+def load_nodes(nodepath, descender, host, port, password, layout=MULTIDB, node_format=JSON_NODES, processes=0,
+               connections=1, export=None, append=False, slot=0):
     # Load jsonl files into Redis
     # The redis database is structured as follows:
     # db0 contains a map from a text node id to an integer node_id.  The int node_id is defined
     #  by this code and is used to index into the other databases.
     # db1 contains a map from the integer node_id to a node.  The node is a json object.
     #  This db is used to pull the big string for the TRAPI response.
+    #  With node_format=fragment, the node is stored ready to splice into a response instead (see keymaster).
     # db2 contains a map from categories to an integer category_id.  This is used to save memory
+    # (In the keyspace layout, these "dbs" are all in redis db0, and each key is prefixed with its db number.)
     # As we parse the nodes, we also want to extract the biolink category for each one and
-    #  create a dictionary from (original) node_id to category.  We also need to keep a dictionary
+    #  create a map from (original) node_id to category.  We also need to keep a map
     #  in python with the node_id->integer node id mapping.  We will use this to create the edges.
+    #  These are kept compactly (see node_map), rather than as dicts, so that big graphs fit in memory.
+    # With processes > 0, the parsing is done by that many processes, and with connections > 1 the writes go over
+    # that many connections.  Either way, ids are handed out here in file order, so the database is the same.
+    # With export set to a path, nothing goes to redis: the commands are appended to that file in the redis protocol
+    # instead (see RedisExportConnection), and host, port, password and connections are ignored.
+    # With append, the nodes are added to the database that is already in redis: the int ids and category ids carry
+    # on from the ones there, and nodes that are already there are left alone.  The maps that are returned only have
+    # the new nodes.
+    # slot is the blue/green copy of the database to write (see keymaster).
+    if append and export is not None:
+        raise ValueError("An incremental load needs to read redis, so it can't be exported")
 
-
-    with RedisConnection(host, port, password) as rc:
+    with load_connection(host, port, password, layout, connections, export, slot) as rc:
         pipelines = rc.get_pipelines()
 
-        nodeid_to_categories = defaultdict(list)
-        nodeid_to_intnodeid = {}
-        categories_to_id = {}
+        if append:
+            last_node_id = read_counter(rc, "last_node_id")
+            categories_to_id = read_ids(rc, 2)
+        else:
+            last_node_id = 0
+            categories_to_id = {}
+        nodeid_to_categories = CategoryColumn(first_id=last_node_id + 1)
+        nodeid_to_intnodeid = CurieMap()
+        skipped = set()
 
-        last_node_id = 0
+        first_node_id = last_node_id
+        start = time.perf_counter()
 
         # for loading performance, we want to pipeline the loads
-        with open(nodepath) as f:
-            for line in f:
-                record = json.loads(line)
-                record_id = record['id']
-                fixnode(record)
-                last_node_id += 1
-                # We need to look for conflated things like gene/protein. It will have multiple categories
-                categories = descender.get_deepest_types(record['categories'])
-                for category in categories:
-                    if category not in categories_to_id:
-                        category_id = len(categories_to_id)
-                        categories_to_id[category] = category_id
-                    category_id = categories_to_id[category]
-                    pipelines[2].set(category, category_id)
-                    nodeid_to_categories[last_node_id].append(categories_to_id[category])
-                nodeid_to_intnodeid[record_id] = last_node_id
-                pipelines[0].set(record_id, last_node_id)
-                pipelines[1].set(last_node_id, json.dumps(record))
-                if last_node_id % 10000 == 0:
-                    print("Node", last_node_id)
-                    rc.flush_pipelines()
+        state = {"descender": descender, "node_format": node_format}
+        records = prepared_records(nodepath, prepare_nodes, state, processes)
+        if append:
+            records = skip_existing_nodes(rc, records, skipped)
+        for record_id, categories, value in records:
+            last_node_id += 1
+            category_ids = []
+            for category in categories:
+                if category not in categories_to_id:
+                    category_id = len(categories_to_id)
+                    categories_to_id[category] = category_id
+                category_id = categories_to_id[category]
+                pipelines[2].set(rc.key(2, category), category_id)
+                category_ids.append(category_id)
+            nodeid_to_categories.append(category_ids)
+            nodeid_to_intnodeid[record_id] = last_node_id
+            pipelines[0].set(rc.key(0, record_id), last_node_id)
+            pipelines[1].set(rc.key(1, last_node_id), value)
+            if last_node_id % 10000 == 0:
+                report("Node", last_node_id - first_node_id, start)
+                rc.flush_pipelines()
+        pipelines[7].set(rc.key(7, "last_node_id"), last_node_id)
+    report("Loaded nodes:", last_node_id - first_node_id, start)
+    if skipped:
+        print("Skipped", len(skipped), "nodes that were already loaded")
+    nodeid_to_categories.finish()
+    nodeid_to_intnodeid.finish(lambda: (curie for chunk in read_chunks(nodepath) for curie in
+                                        (orjson.loads(line)["id"] for line in chunk) if curie not in skipped))
     return nodeid_to_categories, nodeid_to_intnodeid
 
 
-def load_edges(edgepath, descender, nodeid_to_categories, nodeid_to_intnodeid, host, port, password):
+def load_edges(edgepath, descender, nodeid_to_categories, nodeid_to_intnodeid, host, port, password, layout=MULTIDB,
+               pattern_format=LIST_PATTERNS, processes=0, connections=1, export=None, append=False, slot=0,
+               subclass_cap=SUBCLASS_CAP):
     # Load an edge jsonl into redis.  Edges are specified for query by a combination of
     #  predicate and qualifiers, denoted pq.   The databases are structured as:
     # db3: pq -> integer_id_for_pq (for saving mem in the other dbs)
     # db4: integer_edge_id -> edge (for pulling the big string for the TRAPI response)
     # A query pattern will be either (subject_int_id, pq_int_id, type_int_id) or
     #   (type_int_id, -pq_int_id, object_int_id).  The latter is for reverse edges.
-    # db5: query_pattern -> list of integer_edge_ids
-    # db6: int_node_id -> list of subclass integer_node_ids
+    # db5: query_pattern -> list of integer_edge_ids and integer_node_ids
+    #  (with pattern_format=packed, a string of packed (edge_id, node_id) uint32 pairs instead of a list)
+    # db6: int_node_id -> list of all the subclass integer_node_ids, not just the direct ones, up to subclass_cap of
+    #  them (see write_subclasses)
     # db7: several pieces of metadata that are used to reconstruct descender at server startup
+    # processes, connections, export, append and slot are as in load_nodes.  With append, the edges can also use nodes
+    # that were loaded before; the edge ids and pq ids carry on from the ones in redis, the pattern and subclass
+    # lists are extended, and the partial patterns are merged with the ones there.
+    if append and export is not None:
+        raise ValueError("An incremental load needs to read redis, so it can't be exported")
 
-    with RedisConnection(host, port, password) as rc:
+    with load_connection(host, port, password, layout, connections, export, slot) as rc:
         pipelines = rc.get_pipelines()
 
-        last_edge_id = 0
-        pq_to_intpq = {}
+        if append:
+            loaded_format = rc.r[7].get(rc.key(7, "pattern_format"))
+            if loaded_format is not None and loaded_format.decode() != pattern_format:
+                raise ValueError(f"The database has {loaded_format.decode()} patterns, not {pattern_format}")
+            last_edge_id = read_counter(rc, "last_edge_id")
+            pq_to_intpq = read_ids(rc, 3)
+            curie_to_intnodeid, intnodeid_to_categories = \
+                read_existing_nodes(edgepath, nodeid_to_intnodeid, descender, rc)
+            nodeid_to_intnodeid = ChainedMap(nodeid_to_intnodeid, curie_to_intnodeid)
+            nodeid_to_categories = ChainedMap(nodeid_to_categories, intnodeid_to_categories)
+        else:
+            last_edge_id = 0
+            pq_to_intpq = {}
+        first_edge_id = last_edge_id
 
         s_partial_patterns = set()
         o_partial_patterns = set()
+        start = time.perf_counter()
+
+        # The values to push onto each pattern list, gathered up over PATTERN_WINDOW edges so that each key gets one
+        # command with all of them (see write_pushes)
+        pushes = defaultdict(list)
+        # The subclass edges are only written at the end, once they can be followed all the way down
+        subclasses = SubclassIndex()
 
         # read the file
-        with open(edgepath) as f:
-            for line in f:
-                record = json.loads(line)
-                fixed_record = fixedge(record)
-                last_edge_id += 1
-                s_int = nodeid_to_intnodeid[record['subject']]
-                o_int = nodeid_to_intnodeid[record['object']]
-                # Handle subclass of edges differently.
-                if record["predicate"] == "biolink:subclass_of":
-                    if s_int != o_int:
-                        # Eat the self subclasses
-                        pipelines[6].rpush(o_int, s_int)
-                else:
-                    pq = create_pq(fixed_record)
-                    if pq not in pq_to_intpq:
-                        # We can't start at 0 because we are going to use negative numbers to indicate the opposite direction
-                        pq_intid = len(pq_to_intpq) + 1
-                        pq_to_intpq[pq] = pq_intid
-                        pipelines[3].set(pq, pq_intid)
-                    pq_intid = pq_to_intpq[pq]
-                    pipelines[4].set(last_edge_id, json.dumps(fixed_record))
-                    s_cat_ints = nodeid_to_categories[s_int]
-                    o_cat_ints = nodeid_to_categories[o_int]
-                    for s_cat_int in s_cat_ints:
-                        for o_cat_int in o_cat_ints:
-                            spattern = create_query_pattern(s_int, pq_intid, o_cat_int)
-                            opattern = create_query_pattern(s_cat_int, -pq_intid, o_int)
-                            s_partial_patterns.add(f"{pq_intid},{o_cat_int}")
-                            o_partial_patterns.add(f"{s_cat_int},-{pq_intid}")
-                            pipelines[5].rpush(spattern, last_edge_id)
-                            pipelines[5].rpush(spattern, o_int)
-                            pipelines[5].rpush(opattern, last_edge_id)
-                            pipelines[5].rpush(opattern, s_int)
-                if last_edge_id % 10000 == 0:
-                    print("Edge", last_edge_id)
-                    rc.flush_pipelines()
-        write_metadata(rc, descender, s_partial_patterns, o_partial_patterns)
-
-def write_metadata(rc, descender, s_partial_patterns, o_partial_patterns):
+        state = {"nodeid_to_categories": nodeid_to_categories, "nodeid_to_intnodeid": nodeid_to_intnodeid}
+        for pq, s_int, o_int, s_cat_ints, o_cat_ints, value in \
+                prepared_records(edgepath, prepare_edges, state, processes):
+            last_edge_id += 1
+            # Handle subclass of edges differently.
+            if pq is None:
+                if s_int != o_int:
+                    # Eat the self subclasses
+                    subclasses.add(o_int, s_int)
+            else:
+                if pq not in pq_to_intpq:
+                    # We can't start at 0 because we are going to use negative numbers to indicate the opposite direction
+                    pq_intid = len(pq_to_intpq) + 1
+                    pq_to_intpq[pq] = pq_intid
+                    pipelines[3].set(rc.key(3, pq), pq_intid)
+                pq_intid = pq_to_intpq[pq]
+                pipelines[4].set(rc.key(4, last_edge_id), value)
+                for s_cat_int in s_cat_ints:
+                    for o_cat_int in o_cat_ints:
+                        spattern = create_query_pattern(s_int, pq_intid, o_cat_int)
+                        opattern = create_query_pattern(s_cat_int, -pq_intid, o_int)
+                        s_partial_patterns.add((pq_intid, o_cat_int))
+                        o_partial_patterns.add((s_cat_int, pq_intid))
+                        if pattern_format == PACKED_PATTERNS:
+                            pushes[5, spattern].append(create_packed_pattern_entry(last_edge_id, o_int))
+                            pushes[5, opattern].append(create_packed_pattern_entry(last_edge_id, s_int))
+                        else:
+                            pushes[5, spattern].extend((last_edge_id, o_int))
+                            pushes[5, opattern].extend((last_edge_id, s_int))
+            if last_edge_id % PATTERN_WINDOW == 0:
+                write_pushes(rc, pushes, pattern_format)
+            if last_edge_id % 10000 == 0:
+                report("Edge", last_edge_id - first_edge_id, start)
+                rc.flush_pipelines()
+        write_pushes(rc, pushes, pattern_format)
+        write_subclasses(rc, subclasses, subclass_cap, append)
+        # Everything else has to be in redis before the new generation goes in with the metadata
+        rc.sync()
+        write_metadata(rc, descender, s_partial_patterns, o_partial_patterns, pattern_format, last_edge_id, append)
+    report("Loaded edges:", last_edge_id - first_edge_id, start)
+
+def write_pushes(rc, pushes, pattern_format):
+    # Send the values gathered in pushes, a dictionary of (db, key) -> values, and empty it.  Each list gets one
+    # multi-value RPUSH.  Packed patterns get one APPEND of all their entries, which is the same string as appending
+    # them one at a time.
+    pipelines = rc.get_pipelines()
+    for (db, key), values in pushes.items():
+        if db == 5 and pattern_format == PACKED_PATTERNS:
+            pipelines[db].append(rc.key(db, key), b"".join(values))
+        else:
+            pipelines[db].rpush(rc.key(db, key), *values)
+    pushes.clear()
+
+def write_subclasses(rc, subclasses, cap, append):
+    # Write db6 from the SubclassIndex of the subclass edges: for every node with subclasses, all of them (the
+    # transitive closure), nearest first, so that a query only needs one LRANGE to expand a curie however deep the
+    # ontology goes.  A node gets at most cap of them, which keeps the top of a big ontology from turning every query
+    # on it into a query on most of the database.
+    # With append, the lists already in redis are followed as well as the new edges, and only the nodes above a new
+    # edge can change.  Their lists are only ever extended, with the subclasses that they don't already have.
+    existing = {}
+    new_parents = set()
+    if append:
+        new_parents = set(subclasses.parents)
+        if new_parents:
+            existing = read_subclasses(rc)
+            for parent, children in existing.items():
+                for child in children:
+                    subclasses.add(parent, child)
+    subclasses.finish()
+    roots = sorted(subclasses.ancestors(new_parents)) if append else subclasses.roots()
+    pipelines = rc.get_pipelines()
+    capped = 0
+    for count, root in enumerate(roots, start=1):
+        closure = subclasses.closure(root, cap)
+        old = existing.get(root, [])
+        if old:
+            old_set = set(old)
+            closure = [child for child in closure if child not in old_set][:max(cap - len(old), 0)]
+        if len(old) + len(closure) >= cap:
+            capped += 1
+        if closure:
+            pipelines[6].rpush(rc.key(6, root), *closure)
+        if count % 10000 == 0:
+            rc.flush_pipelines()
+    if capped:
+        print(capped, "nodes reached the cap of", cap, "subclasses, and only the nearest ones were kept")
+
+def write_metadata(rc, descender, s_partial_patterns, o_partial_patterns, pattern_format=LIST_PATTERNS,
+                   last_edge_id=None, append=False):
     """
     Write metadata to db7 redis to be used at server startup.
     The metadata will consist of these elements:
-    "pq_to_descendants": a json version of descender.pq_to_descendants
-    "type_to_descendants": a json version of descender.type_to_descendants
-    "s_partial_patterns": a set of partial patterns for subject queries
-    "o_partial_patterns": a set of partial patterns for object queries
-    "predicate_symmetries": a dictionary of {predicate: True/False} denoting whether the predicate is symmetric
+    "metadata_version": the version of this format (see keymaster.METADATA_VERSION)
+    "pq_to_descendants": a msgpack version of descender.pq_to_descendants
+    "type_to_descendants": a msgpack version of descender.type_to_descendants
+    "s_partial_patterns": the (pq_int_id, type_int_id) partial patterns for subject queries, as a sorted int32 array
+    "o_partial_patterns": the (type_int_id, pq_int_id) partial patterns for object queries, as a sorted int32 array
+    "predicate_symmetries": a msgpack dictionary of {predicate: True/False} denoting whether the predicate is symmetric
+    "layout": the storage layout (multidb or keyspace) that the database was loaded with
+    "pattern_format": the format of the query patterns in db5 (list or packed)
+    "last_edge_id": the last edge id handed out, for incremental loads (load_nodes writes "last_node_id" itself)
+    "generation": a stamp that is new every time the database is loaded, so the server knows to drop its caches
 
     This is for 3 reasons:
     1. It keeps us from having to recalculate the descendants at server startup (a slow process)
@@ -173,19 +465,71 @@ def write_metadata(rc, descender, s_partial_patterns, o_partial_patterns):
     follow the biolink model and look for every predicate, qualifier, type , then there are about 150k. But in the
     data, there are more like 1k, and this is the main slow part of the related_to query.  By knowing what the
     subpatterns are, we can filter and run much faster.
+
+    Everything is written in one MULTI/EXEC, so the server never sees half of it.  With append, the partial patterns
+    are merged with the ones already in redis, which are WATCHed so that the merge is atomic too.
     """
 
-    db = rc.r[7]
-    db.set("pq_to_descendants", jsonpickle.encode(descender.pq_to_descendants))
-    db.set("type_to_descendants", jsonpickle.encode(descender.type_to_descendants))
-    db.set("s_partial_patterns", jsonpickle.encode(s_partial_patterns))
-    db.set("o_partial_patterns", jsonpickle.encode(o_partial_patterns))
-    db.set("predicate_symmetries", jsonpickle.encode(descender.predicate_is_symmetric))
+    def write(db, s_partial_patterns, o_partial_patterns):
+        db.set(rc.key(7, "metadata_version"), METADATA_VERSION)
+        # msgpack doesn't do sets
+        pq_to_descendants = {pq: sorted(descendants) for pq, descendants in descender.pq_to_descendants.items()}
+        db.set(rc.key(7, "pq_to_descendants"), msgpack.packb(pq_to_descendants))
+        db.set(rc.key(7, "type_to_descendants"), msgpack.packb(descender.type_to_descendants))
+        db.set(rc.key(7, "s_partial_patterns"), create_partial_pattern_array(s_partial_patterns))
+        db.set(rc.key(7, "o_partial_patterns"), create_partial_pattern_array(o_partial_patterns))
+        db.set(rc.key(7, "predicate_symmetries"), msgpack.packb(descender.predicate_is_symmetric))
+        db.set(rc.key(7, "layout"), rc.layout)
+        db.set(rc.key(7, "pattern_format"), pattern_format)
+        if last_edge_id is not None:
+            db.set(rc.key(7, "last_edge_id"), last_edge_id)
+        db.set(rc.key(7, "generation"), uuid.uuid4().hex)
+
+    if not append:
+        db = rc.r[7].pipeline()
+        write(db, s_partial_patterns, o_partial_patterns)
+        db.execute()
+        return
+
+    s_key = rc.key(7, "s_partial_patterns")
+    o_key = rc.key(7, "o_partial_patterns")
+    def merge(db):
+        # Until multi(), the pipeline runs commands right away
+        loaded = [set(map(tuple, read_partial_pattern_array(db.get(key) or b"").tolist())) for key in (s_key, o_key)]
+        db.multi()
+        write(db, s_partial_patterns | loaded[0], o_partial_patterns | loaded[1])
+    rc.r[7].transaction(merge, s_key, o_key)
 
-def load(nodepath, edgepath, host, port, password):
+def load(nodepath, edgepath, host, port, password, layout=MULTIDB, pattern_format=LIST_PATTERNS,
+         node_format=JSON_NODES, processes=0, connections=1, export=None, append=False, switch=False,
+         subclass_cap=SUBCLASS_CAP):
+    # Load into the current slot, or with switch, load into the other slot while the server carries on reading the
+    # current one, and then make the other one current.
+    if switch and (append or export is not None):
+        raise ValueError("A switch has to be a full load into redis")
     descender = Descender()
-    nodeid_to_categories, nodeid_to_intnodeid = load_nodes(nodepath, descender, host, port, password)
-    load_edges(edgepath, descender, nodeid_to_categories, nodeid_to_intnodeid, host, port, password)
+    slot = 0
+    if export is not None:
+        # The nodes and edges are both appended to the export file, so start it empty
+        open(export, "wb").close()
+    else:
+        with RedisLoadConnection(host, port, password, layout) as rc:
+            current_slot = rc.r[0].get(CURRENT_SLOT_KEY)
+        slot = 0 if current_slot is None else int(current_slot)
+        if switch:
+            slot = (slot + 1) % SLOTS
+            # Whatever was left from the load before last
+            with RedisLoadConnection(host, port, password, layout, slot) as rc:
+                rc.clear()
+    nodeid_to_categories, nodeid_to_intnodeid = load_nodes(nodepath, descender, host, port, password, layout,
+                                                           node_format, processes, connections, export, append, slot)
+    load_edges(edgepath, descender, nodeid_to_categories, nodeid_to_intnodeid, host, port, password, layout,
+               pattern_format, processes, connections, export, append, slot, subclass_cap)
+    if switch:
+        # The flip is one SET, and the servers notice it and move over
+        with RedisLoadConnection(host, port, password, layout) as rc:
+            rc.r[0].set(CURRENT_SLOT_KEY, slot)
+        print("Switched to slot", slot)
 
 
 if __name__ == "__main__":
@@ -193,8 +537,39 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Load KGX jsonl files into Redis')
     parser.add_argument('nodepath', help='path to KGX jsonl node file')
     parser.add_argument('edgepath', help='path to KGX jsonl edge file')
-    parser.add_argument('host', help='Redis host')
-    parser.add_argument('port', help='Redis port')
-    parser.add_argument('password', help='Redis password')
+    parser.add_argument('host', nargs='?', help='Redis host')
+    parser.add_argument('port', nargs='?', help='Redis port')
+    parser.add_argument('password', nargs='?', help='Redis password')
+    parser.add_argument('--layout', choices=LAYOUTS, default=MULTIDB,
+                        help='multidb puts each logical db in its own redis db; keyspace puts them all in db0 with '
+                             'prefixed keys, so that a query stage can go to redis as one pipeline')
+    parser.add_argument('--patterns', choices=PATTERN_FORMATS, default=LIST_PATTERNS,
+                        help='list stores query patterns as redis lists of decimal strings; packed stores them as '
+                             'strings of little-endian uint32 pairs, which take much less memory')
+    parser.add_argument('--nodes', choices=NODE_FORMATS, default=JSON_NODES,
+                        help='json stores nodes as json with their ids; fragment stores them without the id, ready to '
+                             'be spliced into a TRAPI response by the server without parsing')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='number of processes to parse the input with (0 parses in the loading process)')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='number of redis connections to write with')
+    parser.add_argument('--export', metavar='PATH',
+                        help='instead of loading redis, write the commands to PATH in the redis protocol, to be loaded '
+                             'later with redis-cli --pipe < PATH.  host, port and password are not needed')
+    parser.add_argument('--append', action='store_true',
+                        help='add the nodes and edges to the database already in redis, rather than loading it from '
+                             'scratch.  --layout and --patterns have to match the ones it was loaded with')
+    parser.add_argument('--switch', action='store_true',
+                        help='load into the other blue/green slot while the server reads the current one, then switch '
+                             'the server over to it')
+    parser.add_argument('--subclass-cap', type=int, default=SUBCLASS_CAP,
+                        help=f'the most subclasses to store for any one node (default {SUBCLASS_CAP})')
     args = parser.parse_args()
-    load(args.nodepath, args.edgepath,  args.host, args.port, args.password)
+    if args.export is None and args.password is None:
+        parser.error('host, port and password are needed unless there is an --export')
+    if args.export is not None and args.append:
+        parser.error('--append needs to read redis, so it cannot be used with --export')
+    if args.switch and (args.export is not None or args.append):
+        parser.error('--switch is a full load into redis, so it cannot be used with --export or --append')
+    load(args.nodepath, args.edgepath,  args.host, args.port, args.password, args.layout, args.patterns, args.nodes,
+         args.processes, args.connections, args.export, args.append, args.switch, args.subclass_cap)
@@ -0,0 +1,141 @@
+# The lua query engine.  Instead of walking the query one round trip at a time from python, the whole one-hop
+# lookup runs inside redis as a script: curie -> int id, subclass expansion, building and reading the query
+# patterns and filtering.  Only the int ids of the edges and their nodes come back to python, which fetches the
+# strings (see query_redis.get_strings and trapi_stream).
+# The script reads keys from all of the logical dbs, so it needs the keyspace layout (one redis db).  It also builds
+# its key names itself rather than getting them in KEYS, so it will not run against Redis Cluster.
+
+import numpy as np
+
+from src.keymaster import PACKED_PATTERNS, slot_db
+
+# ARGV is: the db offset of the slot being read (see keymaster.slot_db), input_is_subject (1 or 0), whether the
+# patterns are packed (1 or 0), then the number of (pq_int_id, type_int_id) pairs followed by the pairs, then the
+# number of input curies followed by the curies, then the number of filter curies (-1 for no filter) followed by the
+# filter curies.
+# Returns {used_input_ids, edge_ids, edge_input_ids, edge_output_ids}, just like query_redis.find_edges.
+GQUERY_LUA = """
+-- Set from ARGV below
+local packed
+local offset
+
+-- Must match create_layout_key for the keyspace layout
+local function k(db, key)
+    return (db + offset) .. ':' .. key
+end
+
+-- Given a list of curies, return a list of int ids including the subclasses (all of them, db6 is transitive)
+local function int_node_ids(curies)
+    local ids = {}
+    for _, curie in ipairs(curies) do
+        local iid = redis.call('GET', k(0, curie))
+        if iid then
+            table.insert(ids, iid)
+        end
+    end
+    local n = #ids
+    for i = 1, n do
+        for _, sub in ipairs(redis.call('LRANGE', k(6, ids[i]), 0, -1)) do
+            table.insert(ids, sub)
+        end
+    end
+    return ids
+end
+
+-- Return the interleaved edge and node ids for a query pattern, whatever the pattern format
+local function read_pattern(key)
+    if not packed then
+        return redis.call('LRANGE', key, 0, -1)
+    end
+    local ids = {}
+    local s = redis.call('GET', key)
+    if not s then
+        return ids
+    end
+    -- little-endian uint32s, see create_packed_pattern_entry
+    for i = 1, #s, 4 do
+        local b1, b2, b3, b4 = string.byte(s, i, i + 3)
+        table.insert(ids, tostring(b1 + b2 * 256 + b3 * 65536 + b4 * 16777216))
+    end
+    return ids
+end
+
+local pos = 1
+local function take(n)
+    local values = {}
+    for i = pos, pos + n - 1 do
+        table.insert(values, ARGV[i])
+    end
+    pos = pos + n
+    return values
+end
+
+offset = tonumber(take(1)[1])
+local input_is_subject = take(1)[1] == '1'
+packed = take(1)[1] == '1'
+local pairs_ = take(2 * tonumber(take(1)[1]))
+local input_ids = int_node_ids(take(tonumber(take(1)[1])))
+local nfilter = tonumber(take(1)[1])
+local filter = nil
+if nfilter >= 0 then
+    filter = {}
+    for _, fid in ipairs(int_node_ids(take(nfilter))) do
+        filter[fid] = true
+    end
+end
+
+local edge_ids, edge_input_ids, edge_output_ids = {}, {}, {}
+local used_input_ids, seen_input = {}, {}
+for p = 1, #pairs_, 2 do
+    local pq, t = pairs_[p], pairs_[p + 1]
+    for _, iid in ipairs(input_ids) do
+        local pattern
+        if input_is_subject then
+            pattern = iid .. ',' .. pq .. ',' .. t
+        else
+            pattern = t .. ',-' .. pq .. ',' .. iid
+        end
+        local results = read_pattern(k(5, pattern))
+        if #results > 0 and not seen_input[iid] then
+            seen_input[iid] = true
+            table.insert(used_input_ids, iid)
+        end
+        for i = 1, #results, 2 do
+            local oid = results[i + 1]
+            if filter == nil or filter[oid] then
+                table.insert(edge_ids, results[i])
+                table.insert(edge_input_ids, iid)
+                table.insert(edge_output_ids, oid)
+            end
+        end
+    end
+end
+
+return {used_input_ids, edge_ids, edge_input_ids, edge_output_ids}
+"""
+
+
+async def lua_find_edges(input_curies, pattern_pairs, input_is_subject, pattern_format, rc, filter_curies = None):
+    # Given the input curies, the (pq_int_id, type_int_id) pairs from Descender.get_expansion_plan, the direction and
+    # the pattern format, run the one-hop in redis and return the same numpy arrays as query_redis.find_edges.
+    # The ids come back from redis as decimal strings.
+    used_input_ids, edge_ids, edge_input_ids, edge_output_ids = \
+        await run_gquery(input_curies, pattern_pairs, input_is_subject, pattern_format, rc, filter_curies)
+    return tuple(np.array(ids, dtype=np.int64) for ids in
+                 (sorted(map(int, used_input_ids)), edge_ids, edge_input_ids, edge_output_ids))
+
+
+async def run_gquery(input_curies, pattern_pairs, input_is_subject, pattern_format, rc, filter_curies):
+    script = rc.register_script("gquery", GQUERY_LUA)
+    args = [slot_db(rc.slot, 0), 1 if input_is_subject else 0, 1 if pattern_format == PACKED_PATTERNS else 0,
+            len(pattern_pairs)]
+    for pq_int_id, type_int_id in pattern_pairs:
+        args.extend([pq_int_id, type_int_id])
+    args.append(len(input_curies))
+    args.extend(input_curies)
+    if filter_curies is None:
+        args.append(-1)
+    else:
+        args.append(len(filter_curies))
+        args.extend(filter_curies)
+    return await script(keys=[], args=args)
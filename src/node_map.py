@@ -0,0 +1,177 @@
+# Compact versions of the maps that the loader keeps for every node while it loads the edges: curie -> int node id,
+# and int node id -> category ids, and the subclass edges.  As python dicts of strings and lists these take a few
+# hundred bytes a node; these take a few tens.
+
+from array import array
+import hashlib
+
+import numpy as np
+
+
+def hash_curie(curie):
+    return int.from_bytes(hashlib.blake2b(curie.encode(), digest_size=8).digest(), "little")
+
+
+class CurieMap:
+    # Map from curie to int node id.  The curies themselves aren't kept: only a 64 bit hash of each, in a sorted numpy
+    # array alongside the int ids, which is searched with searchsorted.
+    # Fill it with map[curie] = int_id, then call finish() before looking anything up.  If two curies in the map have
+    # the same hash, finish() reads the curies back (in the order they were added) to keep those ones in an ordinary
+    # dict.  A curie that was never added is a KeyError, unless it happens to share a hash with one that was, which
+    # for 64 bits is vanishingly unlikely.
+    def __init__(self):
+        self.hashes = array("Q")
+        self.int_ids = array("q")
+        self.collisions = {}
+
+    def __setitem__(self, curie, int_id):
+        self.hashes.append(hash_curie(curie))
+        self.int_ids.append(int_id)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def finish(self, reread_curies):
+        # reread_curies is called (only if there are collisions) to get the curies again in the order they were added
+        hashes = np.frombuffer(self.hashes, dtype=np.uint64)
+        int_ids = np.frombuffer(self.int_ids, dtype=np.int64)
+        # A stable sort, so that if a curie was added twice, the later int id wins, as with a dict
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.int_ids = int_ids[order]
+        repeated = self.hashes[1:] == self.hashes[:-1]
+        if repeated.any():
+            repeated_hashes = set(self.hashes[1:][repeated].tolist())
+            for curie, int_id in zip(reread_curies(), int_ids.tolist()):
+                if hash_curie(curie) in repeated_hashes:
+                    self.collisions[curie] = int_id
+
+    def __getitem__(self, curie):
+        if curie in self.collisions:
+            return self.collisions[curie]
+        h = np.uint64(hash_curie(curie))
+        # The last of any run of equal hashes
+        i = np.searchsorted(self.hashes, h, side="right") - 1
+        if i < 0 or self.hashes[i] != h:
+            raise KeyError(curie)
+        return int(self.int_ids[i])
+
+
+class CategoryColumn:
+    # Map from int node id to the list of its category ids, for int node ids first_id, first_id + 1, ... as the loader
+    # hands them out.  The lists are stored end to end in one int32 array, with the offset of each node's list in
+    # another (a CSR layout).  Fill it with append(), in int node id order, then call finish() before looking anything
+    # up.
+    def __init__(self, first_id=1):
+        self.first_id = first_id
+        self.category_ids = array("i")
+        self.offsets = array("q", [0])
+
+    def append(self, category_ids):
+        self.category_ids.extend(category_ids)
+        self.offsets.append(len(self.category_ids))
+
+    def finish(self):
+        self.category_ids = np.frombuffer(self.category_ids, dtype=np.int32)
+        self.offsets = np.frombuffer(self.offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, int_id, default=None):
+        i = int_id - self.first_id
+        if i < 0 or i >= len(self):
+            return default
+        return self.category_ids[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def __getitem__(self, int_id):
+        categories = self.get(int_id)
+        if categories is None:
+            raise KeyError(int_id)
+        return categories
+
+
+class ChainedMap:
+    # Look keys up in each of several maps in turn, for instance the nodes from this load and then the ones that were
+    # already in redis.
+    def __init__(self, *maps):
+        self.maps = maps
+
+    def __getitem__(self, key):
+        for m in self.maps:
+            try:
+                return m[key]
+            except KeyError:
+                pass
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        for m in self.maps:
+            value = m.get(key)
+            if value is not None:
+                return value
+        return default
+
+
+
+class SubclassIndex:
+    # The subclass_of edges between int node ids, for working out every subclass of a node, however deep.  The edges
+    # are kept as two int64 arrays, sorted by parent (and a second copy sorted by child, for going up) once finish() is
+    # called.  Fill it with add(parent, child), then call finish() before asking for anything.
+    def __init__(self):
+        self.parents = array("q")
+        self.children = array("q")
+
+    def add(self, parent, child):
+        self.parents.append(parent)
+        self.children.append(child)
+
+    def __len__(self):
+        return len(self.parents)
+
+    def finish(self):
+        parents = np.frombuffer(self.parents, dtype=np.int64)
+        children = np.frombuffer(self.children, dtype=np.int64)
+        down = np.argsort(parents, kind="stable")
+        self.parents, self.children = parents[down], children[down]
+        up = np.argsort(children, kind="stable")
+        self.up_children, self.up_parents = children[up], parents[up]
+
+    def roots(self):
+        """Return the int ids that have any subclasses."""
+        return np.unique(self.parents).tolist()
+
+    def closure(self, root, cap):
+        """Return up to cap subclasses of root, going down breadth first so that if there are too many, it's the
+        furthest ones that are left out.  root itself is never in the list, even if the ontology has a cycle."""
+        seen = {root}
+        out = []
+        frontier = [root]
+        while frontier:
+            next_frontier = []
+            for node in frontier:
+                start, end = np.searchsorted(self.parents, [node, node + 1])
+                for child in self.children[start:end].tolist():
+                    if child not in seen:
+                        if len(out) == cap:
+                            return out
+                        seen.add(child)
+                        out.append(child)
+                        next_frontier.append(child)
+            frontier = next_frontier
+        return out
+
+    def ancestors(self, int_ids):
+        """Return int_ids and all of their superclasses, as a set."""
+        seen = set(int_ids)
+        frontier = list(seen)
+        while frontier:
+            next_frontier = []
+            for node in frontier:
+                start, end = np.searchsorted(self.up_children, [node, node + 1])
+                for parent in self.up_parents[start:end].tolist():
+                    if parent not in seen:
+                        seen.add(parent)
+                        next_frontier.append(parent)
+            frontier = next_frontier
+        return seen
@@ -1,4 +1,11 @@
-from src.keymaster import create_query_pattern
+import asyncio
+from itertools import chain
+
+import numpy as np
+
+from src.keymaster import create_query_pattern, PACKED_PATTERNS, PACKED_DTYPE
+from src.redis_connector import LUA_ENGINE
+from src.lua_query import lua_find_edges
 
 async def bquery(subjects, pq, objects, descender, rc):
     # Given a list of subject curies, a predicate/qualifier string, and a list of object curies,
@@ -26,6 +33,7 @@ async def gquery(input_curies, pq, output_type, input_is_subject, descender, rc,
     # Given a list of input curies, a predicate/qualifier string, and an output type, return a list of TRAPI
     # nodes and a list of trapi edges.
     # Optionally filter the output nodes by a list of curies (and their subclasses).
+    # The nodes and edges come back as the json strings from redis.
     # To do this, query the redis db, which has the following structure:
     # db0 contains a map from a text node id to an integer node_id.  The int node_id is defined
     #  by this code and is used to index into the other databases.
@@ -38,90 +46,392 @@ async def gquery(input_curies, pq, output_type, input_is_subject, descender, rc,
     #   (type_int_id, -pq_int_id, object_int_id).  The latter is for reverse edges.
     # db5: query_pattern -> interleaved list of integer_edge_ids and integer_node_ids
     #  In other words, [ edge_id, node_id, edge_id, node_id, ...]
+    #  In the packed pattern format, the same thing as one string of little-endian uint32s.
+    # With the lua engine, everything from the curies to the edge ids happens inside redis.
+
+    if rc.engine == LUA_ENGINE:
+        pattern_pairs, pattern_format = await asyncio.gather(
+            descender.get_expansion_plan(pq, output_type, input_is_subject), descender.get_pattern_format())
+        input_int_ids, edge_ids, _, output_node_ids = \
+            await lua_find_edges(input_curies, pattern_pairs, input_is_subject, pattern_format, rc, filter_curies)
+    else:
+        input_int_ids, edge_ids, _, output_node_ids = \
+            await find_edges(input_curies, pq, output_type, input_is_subject, descender, rc, filter_curies)
+
+    # redis wants python ints, not numpy ones
+    input_int_ids = input_int_ids.tolist()
+    output_node_ids = output_node_ids.tolist()
+    edge_ids = edge_ids.tolist()
+
+    return await get_strings(input_int_ids, output_node_ids, edge_ids,rc)
+
+
+async def bquery_ids(subjects, pq, objects, descender, rc, page = None):
+    # Like bquery, but stop at the int ids, as gquery_ids does.
+    if len(subjects) < len(objects):
+        return await gquery_ids(subjects, pq, "biolink:NamedThing", True, descender, rc, objects, page)
+    return await gquery_ids(objects, pq, "biolink:NamedThing", False, descender, rc, subjects, page)
+
+
+async def gquery_ids(input_curies, pq, output_type, input_is_subject, descender, rc, filter_curies = None,
+                     page = None):
+    # Like gquery, but stop at the int ids rather than pulling the strings.  Returns numpy arrays
+    # (node_ids, edge_ids, edge_subject_ids, edge_object_ids): the ids of all of the nodes in the answer, and for each
+    # edge its id and the ids of its subject and object.  Because the edges come with their subjects and objects, the
+    # caller doesn't need to parse the edges to bind them (see trapi_stream).
+    # With a Page, only that page of the edges comes back, and page.next is set.
+    if rc.engine == LUA_ENGINE and page is None:
+        pattern_pairs, pattern_format = await asyncio.gather(
+            descender.get_expansion_plan(pq, output_type, input_is_subject), descender.get_pattern_format())
+        found = await lua_find_edges(input_curies, pattern_pairs, input_is_subject, pattern_format, rc, filter_curies)
+    else:
+        found, = await find_edges_directions(input_curies, pq, output_type, [input_is_subject], descender, rc,
+                                             filter_curies, page)
+    return orient_edges(found, input_is_subject)
 
-    pipelines = rc.get_pipelines()
 
-    input_int_ids = await rc.get_int_node_ids(input_curies)
-    if filter_curies is not None:
-        filter_int_ids = await rc.get_int_node_ids(filter_curies)
+async def bquery_ids_both_ways(subjects, pq, objects, descender, rc, page = None):
+    # Like bquery_ids, for a symmetric predicate: returns (forward, reverse), the ids for (subjects, pq, objects) and
+    # for (objects, pq, subjects).  Both go from the smaller list of curies, one with it as the subject and one with it
+    # as the object, so they are one gquery_ids_both_ways.
+    if len(subjects) < len(objects):
+        return await gquery_ids_both_ways(subjects, pq, "biolink:NamedThing", True, descender, rc, objects, page)
+    return await gquery_ids_both_ways(objects, pq, "biolink:NamedThing", False, descender, rc, subjects, page)
 
-    # TODO: the int id for the pq and types should probably be cached somewhere, maybe in the Descender and
-    #  looked up in redis at start time.
 
-    # Get the int_id for the pq:
-    pq_int_ids = await descender.get_pq_descendant_int_ids(pq)
+async def gquery_ids_both_ways(input_curies, pq, output_type, input_is_subject, descender, rc, filter_curies = None,
+                               page = None):
+    # gquery_ids for a symmetric predicate.  Returns (forward, reverse), each like gquery_ids: forward for the query as
+    # asked, and reverse for the input curies on the other side of the edge.  Rather than running the query twice, the
+    # curies are resolved once and the patterns for both directions are read together (see find_edges_directions).
+    # A Page runs across both directions, forward first.
+    directions = [input_is_subject, not input_is_subject]
+    if rc.engine == LUA_ENGINE and page is None:
+        # The lua engine resolves the curies inside redis, so it runs once in each direction, both at the same time
+        pattern_format, *plans = await asyncio.gather(
+            descender.get_pattern_format(),
+            *(descender.get_expansion_plan(pq, output_type, direction) for direction in directions))
+        found = await asyncio.gather(*(lua_find_edges(input_curies, pattern_pairs, direction, pattern_format, rc,
+                                                      filter_curies)
+                                       for pattern_pairs, direction in zip(plans, directions)))
+    else:
+        found = await find_edges_directions(input_curies, pq, output_type, directions, descender, rc, filter_curies,
+                                            page)
+    return tuple(orient_edges(f, direction) for f, direction in zip(found, directions))
 
-    # Get the int_id for the output type and its descendants
-    type_int_ids = await get_type_int_ids(descender, output_type, rc)
 
-    # create_query_pattern
-    iid_list = []
-    query_patterns = []
+def orient_edges(found, input_is_subject):
+    # Turn what find_edges returns into what gquery_ids returns
+    input_int_ids, edge_ids, edge_input_ids, edge_output_ids = found
+    node_ids = np.union1d(input_int_ids, edge_output_ids)
     if input_is_subject:
-        for type_int_id in type_int_ids:
-            for pq_int_id in pq_int_ids:
-                #Filter to the ones that are actually in the db
-                if f"{pq_int_id},{type_int_id}" in await descender.get_s_partial_patterns():
-                    for iid in input_int_ids:
+        return node_ids, edge_ids, edge_input_ids, edge_output_ids
+    return node_ids, edge_ids, edge_output_ids, edge_input_ids
+
+
+async def find_edges(input_curies, pq, output_type, input_is_subject, descender, rc, filter_curies = None):
+    # The python engine's walk of a one-hop query, down to int ids (see gquery for the db layout).  Returns numpy
+    # arrays (input_int_ids, edge_ids, edge_input_ids, edge_output_ids): the input nodes that gave any results, and
+    # then one entry per edge with its id and the ids of its input and output nodes.
+    found, = await find_edges_directions(input_curies, pq, output_type, [input_is_subject], descender, rc,
+                                         filter_curies)
+    return found
+
+
+async def build_query_patterns(input_curies, pq, output_type, directions, descender, rc, filter_curies = None):
+    # Resolve the curies and build the query patterns for each input_is_subject in directions, one direction after the
+    # other.  Returns (query_patterns, iid_list, pattern_counts, pattern_format, filter_int_ids): the patterns, the
+    # input int id of each pattern, how many patterns each direction has, the pattern format, and the int ids of the
+    # filter curies (None without a filter).
+    built, = await build_query_patterns_batch([(input_curies, pq, output_type, directions, filter_curies)],
+                                              descender, rc)
+    return built
+
+
+async def build_query_patterns_batch(queries, descender, rc):
+    # build_query_patterns for each (input_curies, pq, output_type, directions, filter_curies) in queries, with all of
+    # the curies resolved together in one get_int_node_ids.
+    # Resolving the curies and working out the patterns to look at don't depend on each other, so they go at once
+    curie_lists = []
+    plan_keys = []
+    for input_curies, pq, output_type, directions, filter_curies in queries:
+        curie_lists.append(input_curies)
+        if filter_curies is not None:
+            curie_lists.append(filter_curies)
+        plan_keys.extend((pq, output_type, input_is_subject) for input_is_subject in directions)
+    int_id_lists, pattern_format, *plans = await asyncio.gather(
+        rc.get_int_node_ids(*curie_lists),
+        descender.get_pattern_format(),
+        *(descender.get_expansion_plan(*key) for key in plan_keys))
+    int_id_lists = iter(int_id_lists)
+    plans = iter(plans)
+
+    built = []
+    for input_curies, pq, output_type, directions, filter_curies in queries:
+        input_int_ids = next(int_id_lists)
+        filter_int_ids = None if filter_curies is None else next(int_id_lists)
+        # create_query_pattern
+        iid_list = []
+        query_patterns = []
+        pattern_counts = []
+        for input_is_subject in directions:
+            start = len(query_patterns)
+            for pq_int_id, type_int_id in next(plans):
+                for iid in input_int_ids:
+                    if input_is_subject:
                         query_patterns.append(create_query_pattern(iid, pq_int_id, type_int_id))
-                        iid_list.append(iid)
+                    else:
+                        query_patterns.append(create_query_pattern(type_int_id, -pq_int_id, iid))
+                    iid_list.append(iid)
+            pattern_counts.append(len(query_patterns) - start)
+        # We need to make the iid_list in the same way as query_patterns so that we can
+        # extract the iids that actually gave results to return them
+        # iid_list = [iid for iid in input_int_ids for type_int_id in type_int_ids for pq_int_id in pq_int_ids]
+        built.append((query_patterns, iid_list, pattern_counts, pattern_format, filter_int_ids))
+    return built
+
+
+async def gquery_counts(input_curies, pq, output_type, input_is_subject, descender, rc, filter_curies = None,
+                        both_ways = False):
+    # How many edges gquery would find, without reading them: returns a dictionary of query pattern -> number of
+    # edges, for the patterns that have any (the total is the sum).  With both_ways, the patterns for the other
+    # direction are counted too, as for gquery_ids_both_ways.
+    # Without a filter this is only the length of each pattern (LLEN, or STRLEN for packed patterns), however many
+    # edges there are.  With a filter, the output node ids have to be checked, so the patterns are read, but the
+    # nodes and edges still aren't.  Counts always come from python, whatever the engine.
+    # Because the nodes and edges aren't read, an edge that trapi_stream would drop (its string, or its subject's or
+    # object's, isn't in redis) is still counted, so for a database with such edges the counts are an upper bound.
+    directions = [input_is_subject, not input_is_subject] if both_ways else [input_is_subject]
+    query_patterns, _, _, pattern_format, filter_int_ids = \
+        await build_query_patterns(input_curies, pq, output_type, directions, descender, rc, filter_curies)
+    if filter_int_ids is None:
+        counts = await get_pattern_lengths(rc, query_patterns, pattern_format)
     else:
-        for type_int_id in type_int_ids:
-            for pq_int_id in pq_int_ids:
-                #Filter to the ones that are actually in the db
-                if f"{type_int_id},-{pq_int_id}" in await descender.get_o_partial_patterns():
-                    for iid in input_int_ids:
-                        query_patterns.append(create_query_pattern(type_int_id, -pq_int_id, iid) )
-                        iid_list.append(iid)
-    # We need to make the iid_list in the same way as query_patterns so that we can
-    # extract the iids that actually gave results to return them
-    # iid_list = [iid for iid in input_int_ids for type_int_id in type_int_ids for pq_int_id in pq_int_ids]
-
-    # Now, get the list of edge ids that match the query patterns
-    results = await get_results_for_query_patterns(pipelines, query_patterns)
-    # Keep the input_iids that returned results
-    # This is kind of messy b/c you have to know if the iid is in the subject or object position of the query pattern
-    input_int_ids = list(set([iid_list[i] for i in range(len(iid_list)) if len(results[i]) > 0]))
-    # Flatten the list of lists into a single list:
-    edge_and_outputnode_ids = [int(item) for sublist in results for item in sublist]
-    # Deconvolve the edge ids from the output node ids
-    edge_ids = edge_and_outputnode_ids[::2]
-    output_node_ids = edge_and_outputnode_ids[1::2]
-
-    if filter_curies is not None:
-        # Now filter out the output nodes and associated edges that don't match the filter curies
-        filtered_edge_ids = []
-        filtered_output_node_ids = []
-        for edge_id, output_node_id in zip(edge_ids, output_node_ids):
-            if output_node_id in filter_int_ids:
-                filtered_edge_ids.append(edge_id)
-                filtered_output_node_ids.append(output_node_id)
-        edge_ids = filtered_edge_ids
-        output_node_ids = filtered_output_node_ids
+        edge_and_outputnode_ids, lengths = await get_results_for_query_patterns(rc, query_patterns, pattern_format)
+        keep = np.isin(edge_and_outputnode_ids[1::2], np.array(filter_int_ids, dtype=np.int64))
+        edge_patterns = np.repeat(np.arange(len(query_patterns)), lengths // 2)
+        counts = np.bincount(edge_patterns[keep], minlength=len(query_patterns)).tolist()
+    # The same pattern is in the list more than once when an input id is (a curie and one of its subclasses, say), and
+    # the query finds its edges each time, so its count has to be added up to match
+    pattern_counts = {}
+    for qp, count in zip(query_patterns, counts):
+        if count > 0:
+            pattern_counts[qp] = pattern_counts.get(qp, 0) + count
+    return pattern_counts
 
-    return await get_strings(input_int_ids, output_node_ids, edge_ids,rc)
 
+async def bquery_counts(subjects, pq, objects, descender, rc, both_ways = False):
+    # Like bquery_ids, but counts, as gquery_counts does.
+    if len(subjects) < len(objects):
+        return await gquery_counts(subjects, pq, "biolink:NamedThing", True, descender, rc, objects, both_ways)
+    return await gquery_counts(objects, pq, "biolink:NamedThing", False, descender, rc, subjects, both_ways)
 
-async def get_results_for_query_patterns(pipelines, query_patterns):
-    for qp in query_patterns:
-        pipelines[5].lrange(qp, 0, -1)
-    results = await pipelines[5].execute()
+
+async def find_edges_directions(input_curies, pq, output_type, directions, descender, rc, filter_curies = None,
+                                page = None):
+    # find_edges for each input_is_subject in directions, returning a list with what find_edges returns for each.
+    # The curies are only resolved once, and the query patterns for all of the directions go in one pipeline.
+    # With a Page, only a window of the patterns is read (see plan_page).  The lua engine has no pages, so paged
+    # queries always come here.
+    query_patterns, iid_list, pattern_counts, pattern_format, filter_int_ids = \
+        await build_query_patterns(input_curies, pq, output_type, directions, descender, rc, filter_curies)
+    all_iids = np.array(iid_list, dtype=np.int64)
+    windows = None
+    if page is not None:
+        selected, windows = await plan_page(rc, query_patterns, pattern_format, page)
+        query_patterns = [query_patterns[i] for i in selected]
+        all_iids = all_iids[selected]
+        # Which direction each pattern came from, to count how many of each are left
+        pattern_directions = np.repeat(np.arange(len(directions)), pattern_counts)[selected]
+        pattern_counts = np.bincount(pattern_directions, minlength=len(directions)).tolist()
+
+    # Now, get the edge ids that match the query patterns, as one flat array of interleaved edge and node ids
+    all_edge_and_outputnode_ids, all_lengths = await get_results_for_query_patterns(rc, query_patterns, pattern_format,
+                                                                                    windows)
+    return split_edges(all_edge_and_outputnode_ids, all_lengths, all_iids, pattern_counts, filter_int_ids)
+
+
+def split_edges(all_edge_and_outputnode_ids, all_lengths, all_iids, pattern_counts, filter_int_ids):
+    # Given what get_results_for_query_patterns read for the patterns of a query, with the input int id of each pattern
+    # and how many patterns each direction has, return what find_edges returns for each direction.  filter_int_ids is
+    # None for no filter.
+    if filter_int_ids is not None:
+        filter_int_ids = np.array(filter_int_ids, dtype=np.int64)
+    found = []
+    pattern_start = 0
+    id_start = 0
+    for pattern_count in pattern_counts:
+        # This direction's share of the patterns and what came back for them
+        lengths = all_lengths[pattern_start:pattern_start + pattern_count]
+        iid_array = all_iids[pattern_start:pattern_start + pattern_count]
+        edge_and_outputnode_ids = all_edge_and_outputnode_ids[id_start:id_start + lengths.sum()]
+        pattern_start += pattern_count
+        id_start += lengths.sum()
+        # Keep the input_iids that returned results
+        # This is kind of messy b/c you have to know if the iid is in the subject or object position of the query pattern
+        used_input_ids = np.unique(iid_array[lengths > 0])
+        # Deconvolve the edge ids from the output node ids
+        edge_ids = edge_and_outputnode_ids[::2]
+        output_node_ids = edge_and_outputnode_ids[1::2]
+        # Each pattern gave lengths/2 edges, all from the same input node
+        edge_input_ids = np.repeat(iid_array, lengths // 2)
+
+        if filter_int_ids is not None:
+            # Now filter out the output nodes and associated edges that don't match the filter curies
+            keep = np.isin(output_node_ids, filter_int_ids)
+            edge_ids = edge_ids[keep]
+            output_node_ids = output_node_ids[keep]
+            edge_input_ids = edge_input_ids[keep]
+        found.append((used_input_ids, edge_ids, edge_input_ids, output_node_ids))
+    return found
+
+
+async def gquery_ids_batch(queries, descender, rc):
+    # Run many one-hop queries at once.  Each query is (input_curies, pq, output_type, input_is_subject,
+    # filter_curies, both_ways), as for gquery_ids (or gquery_ids_both_ways, with both_ways).  Returns a list with
+    # (forward, reverse) for each query, reverse being None without both_ways.
+    # All of the curies are resolved together, and all of the patterns are read in one pipeline, each only once
+    # however many of the queries need it.  Like pages and counts, batches always come through python.
+    directions = [[input_is_subject, not input_is_subject] if both_ways else [input_is_subject]
+                  for _, _, _, input_is_subject, _, both_ways in queries]
+    built = await build_query_patterns_batch(
+        [(input_curies, pq, output_type, query_directions, filter_curies)
+         for (input_curies, pq, output_type, _, filter_curies, _), query_directions in zip(queries, directions)],
+        descender, rc)
+    if not built:
+        return []
+    pattern_format = built[0][3]
+    pattern_index = {}
+    for query_patterns, _, _, _, _ in built:
+        for qp in query_patterns:
+            pattern_index.setdefault(qp, len(pattern_index))
+    values, lengths = await get_results_for_query_patterns(rc, list(pattern_index), pattern_format)
+    starts = np.concatenate([[0], np.cumsum(lengths)])
+
+    results = []
+    for (query_patterns, iid_list, pattern_counts, _, filter_int_ids), query_directions in zip(built, directions):
+        # This query's patterns, picked out of the shared results
+        indexes = [pattern_index[qp] for qp in query_patterns]
+        query_lengths = lengths[indexes] if indexes else np.zeros(0, dtype=np.int64)
+        query_values = np.concatenate([values[starts[i]:starts[i + 1]] for i in indexes]) if indexes else \
+            np.zeros(0, dtype=np.int64)
+        found = split_edges(query_values, query_lengths, np.array(iid_list, dtype=np.int64), pattern_counts,
+                            filter_int_ids)
+        oriented = [orient_edges(f, direction) for f, direction in zip(found, query_directions)]
+        results.append((oriented[0], oriented[1] if len(oriented) > 1 else None))
     return results
 
 
-async def get_type_int_ids(descender, output_type, rc):
-    output_types = await descender.get_type_descendants(output_type)
-    res = await rc.pipeline_gets(2, output_types, True)
-    type_int_ids = res.values()
-    return type_int_ids
+class Page:
+    # A page of a query's edges: up to limit of them, starting from edge offset of query pattern pattern, in the order
+    # that find_edges_directions reads the patterns.  That order only depends on the query and the database, so a
+    # page can be picked up again from another request.  Once the query has run, next is the (pattern, offset) of the
+    # page after this one, or None if this was the last.  With filter curies, the edges that don't pass the filter are
+    # dropped from the page, so a page can have fewer than limit edges and still not be the last.
+    def __init__(self, limit, pattern=0, offset=0):
+        self.limit = limit
+        self.pattern = pattern
+        self.offset = offset
+        self.next = None
 
 
+async def plan_page(rc, query_patterns, pattern_format, page):
+    # Work out which edges of which query patterns make up page.  Returns the indexes of the patterns to read and the
+    # (start, end) window of edges to read from each, and sets page.next.  This is one round trip, for the length of
+    # every pattern from the start of the page on, but then only the page itself is read.
+    edge_counts = await get_pattern_lengths(rc, query_patterns[page.pattern:], pattern_format)
+    selected = []
+    windows = []
+    remaining = page.limit
+    page.next = None
+    for i, count in enumerate(edge_counts):
+        start = page.offset if i == 0 else 0
+        if start >= count:
+            continue
+        if remaining == 0:
+            # There's more, and this is where it starts
+            page.next = (page.pattern + i, start)
+            break
+        end = min(count, start + remaining)
+        selected.append(page.pattern + i)
+        windows.append((start, end))
+        remaining -= end - start
+        if end < count:
+            page.next = (page.pattern + i, end)
+            break
+    return selected, windows
 
 
-async def get_strings(input_int_ids, output_node_ids, edge_ids,rc):
-    input_node_strings = await rc.r[1].mget(set(input_int_ids))
-    output_node_strings = await rc.r[1].mget(set(output_node_ids))
+async def get_pattern_lengths(rc, query_patterns, pattern_format):
+    # Return how many edges each of the query patterns has, without reading them
+    pipe = rc.pipeline(5)
+    for qp in query_patterns:
+        if pattern_format == PACKED_PATTERNS:
+            pipe.strlen(rc.key(5, qp))
+        else:
+            pipe.llen(rc.key(5, qp))
+    lengths = await pipe.execute()
+    if pattern_format == PACKED_PATTERNS:
+        return [length // (2 * np.dtype(PACKED_DTYPE).itemsize) for length in lengths]
+    return [length // 2 for length in lengths]
+
 
-    edge_strings = await rc.r[4].mget(edge_ids)
+async def get_results_for_query_patterns(rc, query_patterns, pattern_format, windows = None):
+    # Return the interleaved edge and node ids from all of the query patterns as one numpy array, along with an array
+    # of how many ids came from each pattern.  windows, if given, has a (start, end) range of edges to read for each
+    # pattern, rather than all of them.
+    if windows is None:
+        windows = [(0, 0)] * len(query_patterns)
+    pipe = rc.pipeline(5)
+    if pattern_format == PACKED_PATTERNS:
+        # Each edge is two uint32s.  GETRANGE 0 -1 is the whole string.
+        entry_size = 2 * np.dtype(PACKED_DTYPE).itemsize
+        for qp, (start, end) in zip(query_patterns, windows):
+            pipe.getrange(rc.key(5, qp), start * entry_size, end * entry_size - 1)
+        values = [b"" if v is None else v for v in await pipe.execute()]
+        lengths = np.array([len(v) for v in values], dtype=np.int64) // np.dtype(PACKED_DTYPE).itemsize
+        return np.frombuffer(b"".join(values), dtype=PACKED_DTYPE).astype(np.int64), lengths
+    # Each edge is two list entries.  LRANGE 0 -1 is the whole list.
+    for qp, (start, end) in zip(query_patterns, windows):
+        pipe.lrange(rc.key(5, qp), 2 * start, 2 * end - 1)
+    results = await pipe.execute()
+    lengths = np.array([len(r) for r in results], dtype=np.int64)
+    return np.fromiter(map(int, chain.from_iterable(results)), dtype=np.int64, count=lengths.sum()), lengths
+
+
+async def get_strings(input_int_ids, output_node_ids, edge_ids,rc):
+    batch = rc.batch()
+    batch.mget(1, set(input_int_ids))
+    batch.mget(1, set(output_node_ids))
+    batch.mget(4, edge_ids)
+    input_node_strings, output_node_strings, edge_strings = await batch.execute()
 
     return input_node_strings, output_node_strings, edge_strings
+
+
+async def get_cached_strings(rc, *requests):
+    # Each request is (db, ids, cache).  For each, return a dictionary of id -> the string for that id in db, going
+    # through the cache so that only the ids that aren't cached are pulled from redis, all in one batch.  Ids that
+    # aren't in redis are left out.  The caches hold the strings just as they came from redis.
+    found = []
+    missing = []
+    batch = rc.batch()
+    for db, ids, cache in requests:
+        strings = {}
+        missing_ids = []
+        for i in dict.fromkeys(ids):
+            string = cache.get(i)
+            if string is None:
+                missing_ids.append(i)
+            else:
+                strings[i] = string
+        batch.mget(db, missing_ids)
+        found.append(strings)
+        missing.append(missing_ids)
+    values = await batch.execute()
+    for (db, ids, cache), strings, missing_ids, missing_strings in zip(requests, found, missing, values):
+        for i, string in zip(missing_ids, missing_strings):
+            if string is not None:
+                strings[i] = string
+                cache.put(i, string, len(string))
+    return found
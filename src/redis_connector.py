@@ -1,48 +1,432 @@
-import redis.asyncio as redis
+import asyncio
+import queue
+import threading
+import time
+import zlib
+
+import redis
+import redis.asyncio as aredis
+
+from src.keymaster import create_layout_key, slot_db, MULTIDB, KEYSPACE, LAYOUTS, SLOTS, CURRENT_SLOT_KEY
+from src.cache import LRUCache
+
+# Query engines.  The python engine walks each query from python; the lua engine runs the whole one-hop inside redis
+# (see lua_query) and needs the keyspace layout.
+PYTHON_ENGINE = "python"
+LUA_ENGINE = "lua"
+ENGINES = [PYTHON_ENGINE, LUA_ENGINE]
 
 class RedisConnection:
-    # RedisConnection is a class that holds a connection to a redis database
-    # it is a context manager and can be used in a with statement
-    def __init__(self,host,port,password):
+    # RedisConnection holds the async connections that the server uses to query the 8 logical redis dbs.
+    # Each db client draws its connections from a bounded, blocking pool, so many concurrent queries can be in flight
+    # without opening an unbounded number of sockets; when the pool is exhausted, callers wait for a free connection.
+    # max_connections bounds the sockets for the whole connection.  In the keyspace layout that's one pool shared by
+    # all of the logical dbs; in the multidb layout each db has its own pool, and gets an eighth of it (at least one).
+    # Pipelines are never shared between calls.  Every call that wants to pipeline commands gets its own pipeline from
+    # pipeline() or batch(), so two concurrent /query coroutines can't interleave commands in one buffer or drain each
+    # other's work.
+    # The layout says how the logical dbs map onto redis (see keymaster).  In the keyspace layout self.r holds the
+    # same db0 client 8 times, and keys have to go through key() to pick up their prefix.
+    # node_cache and edge_cache hold the node and edge strings from redis by int id (see
+    # query_redis.get_cached_strings), bounded by the size of the strings.  They are off (0 bytes) by default.
+    # curie_cache and subclass_cache hold what get_int_node_ids reads from db0 and db6: curie -> int id (0 for a curie
+    # that isn't in the db) and int id -> list of subclass int ids (empty for a node without any).  They are off by
+    # default too.
+    # generation_check is how often, in seconds, get_generation() goes back to redis to see if there has been a load.
+    # slot is which of the blue/green copies of the database to read (see keymaster); self.r and key() take care of it,
+    # so everything else works with logical dbs 0-7 as usual.
+    def __init__(self, host, port, password, max_connections=64, layout=MULTIDB, engine=PYTHON_ENGINE,
+                 node_cache_bytes=0, edge_cache_bytes=0, generation_check=1.0, slot=0, curie_cache_bytes=0,
+                 subclass_cache_bytes=0):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout {layout}")
+        if slot not in range(SLOTS):
+            raise ValueError(f"Unknown slot {slot}")
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}")
+        if engine == LUA_ENGINE and layout != KEYSPACE:
+            raise ValueError("The lua engine needs the keyspace layout")
+        self.layout = layout
+        self.engine = engine
+        self.slot = slot
+        self.scripts = {}
+        self.node_cache = LRUCache(node_cache_bytes)
+        self.edge_cache = LRUCache(edge_cache_bytes)
+        self.curie_cache = LRUCache(curie_cache_bytes)
+        self.subclass_cache = LRUCache(subclass_cache_bytes)
+        self.generation_check = generation_check
+        self.generation = None
+        self.generation_checked = None
         self.r = []
-        for i in range(8):
-            self.r.append(redis.StrictRedis(host=host, port=port, db=i, password=password, socket_connect_timeout=600))
-        self.p = [ rc.pipeline() for rc in self.r ]
-    def __enter__(self):
-        return self
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        for p in self.p:
-            p.execute()
-        for rc in self.r:
-            rc.aclose()
-    def get_pipelines(self):
-        return self.p
-    def flush_pipelines(self):
-        for p in self.p:
-            p.execute()
+        if layout == KEYSPACE:
+            pool = aredis.BlockingConnectionPool(host=host, port=port, db=0, password=password,
+                                                 socket_connect_timeout=600, max_connections=max_connections)
+            self.r = [aredis.StrictRedis(connection_pool=pool)] * 8
+        else:
+            for i in range(8):
+                # A redis connection is bound to a db when it connects, so each db client needs its own pool.
+                pool = aredis.BlockingConnectionPool(host=host, port=port, db=slot_db(slot, i), password=password,
+                                                     socket_connect_timeout=600,
+                                                     max_connections=max(1, max_connections // 8))
+                self.r.append(aredis.StrictRedis(connection_pool=pool))
+
+    def key(self, db, key):
+        """Return the name that key from logical db has in redis."""
+        return create_layout_key(self.layout, slot_db(self.slot, db), key)
+
+    def pipeline(self, db):
+        """Return a new, non-transactional pipeline on db.  The pipeline belongs to the caller only, and hands its
+        connection back to the pool as soon as it has been executed.  Keys still need to go through key()."""
+        return self.r[db].pipeline(transaction=False)
+
+    def batch(self):
+        """Return a new RedisBatch, for sending commands against several logical dbs together."""
+        return RedisBatch(self)
+
+    def register_script(self, name, lua):
+        """Return the script object for lua, registering it the first time.  redis-py runs it with EVALSHA and loads
+        it again if redis has forgotten it."""
+        if name not in self.scripts:
+            self.scripts[name] = self.r[0].register_script(lua)
+        return self.scripts[name]
+
+    async def get_generation(self):
+        """Return the generation stamp that the loader wrote to db7.  It is read from redis at most once every
+        generation_check seconds, so this is cheap enough to call on every request.  When it changes, the caches are
+        dropped."""
+        now = time.monotonic()
+        if self.generation_checked is None or now - self.generation_checked >= self.generation_check:
+            generation = await self.r[7].get(self.key(7, "generation"))
+            if generation != self.generation:
+                # The int ids from the old load mean something else now
+                self.clear_caches()
+            self.generation = generation
+            self.generation_checked = now
+        return self.generation
+
+    def clear_caches(self):
+        self.node_cache.clear()
+        self.edge_cache.clear()
+        self.curie_cache.clear()
+        self.subclass_cache.clear()
+
+    async def get_current_slot(self):
+        """Return the slot that the loader says is current.  The pointer is in redis db 0, which in the multidb layout
+        is only self.r[0] for a slot 0 connection."""
+        slot = await self.r[0].get(CURRENT_SLOT_KEY)
+        return 0 if slot is None else int(slot)
+
+    async def aclose(self):
+        for rc in {id(rc): rc for rc in self.r}.values():
+            await rc.aclose()
 
     async def pipeline_gets(self, pipeline_id, keys, convert_to_int=True):
         """Pipeline get queries for a given pipeline id.  Return as a dictionary, removing keys that don't
         have a value."""
+        batch = self.batch()
         for key in keys:
-            pipe = self.p[pipeline_id]
-            pipe.get(key)
-        values = await self.p[pipeline_id].execute()
+            batch.get(pipeline_id, key)
+        values = await batch.execute()
         if convert_to_int:
             s = {k:int(v) for k,v in zip(keys, values) if v is not None}
             return s
         else:
             return {k:v for k,v in zip(keys, values) if v is not None}
 
-    async def get_int_node_ids(self, input_curies):
-        # Given a list of curies, return a list of integer node ids, including subclasses of the curies
+    async def get_int_node_ids(self, *curie_lists):
+        # Given one or more lists of curies, return a list of integer node ids for each, including subclasses of the
+        # curies.  However many lists there are, this is at most two batches: one for the ids and one for the
+        # subclasses.  Anything in curie_cache or subclass_cache isn't asked for, so curies that keep coming up
+        # (including ones that aren't in the db) don't go to redis at all.
+        if self.curie_cache.max_bytes > 0 or self.subclass_cache.max_bytes > 0:
+            # Drop the caches if there has been a load
+            await self.get_generation()
         # First, get the integer ids for the input curies
-        pg = await self.pipeline_gets(0, input_curies, True)
-        input_int_ids = list(pg.values())
-        # Now, extend the input_int_ids with the subclass ids
-        for iid in input_int_ids:
-            self.p[6].lrange(iid, 0, -1)
-        results = await self.p[6].execute()
-        subclass_int_ids = [int(item) for sublist in results for item in sublist]
-        input_int_ids.extend(subclass_int_ids)
-        return input_int_ids
\ No newline at end of file
+        curie_to_int_id = {}
+        for curies in curie_lists:
+            for curie in curies:
+                curie_to_int_id[curie] = self.curie_cache.get(curie)
+        missing = [curie for curie, int_id in curie_to_int_id.items() if int_id is None]
+        if missing:
+            batch = self.batch()
+            for curie in missing:
+                batch.get(0, curie)
+            for curie, value in zip(missing, await batch.execute()):
+                int_id = 0 if value is None else int(value)
+                curie_to_int_id[curie] = int_id
+                self.curie_cache.put(curie, int_id, len(curie) + 8)
+        int_id_lists = [[curie_to_int_id[curie] for curie in curies if curie_to_int_id[curie]]
+                        for curies in curie_lists]
+        # Now, extend each list with the subclass ids.  db6 has all of a node's subclasses, however deep, so this is
+        # one LRANGE each.
+        subclasses = {}
+        for int_ids in int_id_lists:
+            for iid in int_ids:
+                subclasses[iid] = self.subclass_cache.get(iid)
+        missing = [iid for iid, sub_ids in subclasses.items() if sub_ids is None]
+        if missing:
+            batch = self.batch()
+            for iid in missing:
+                batch.lrange(6, iid, 0, -1)
+            for iid, values in zip(missing, await batch.execute()):
+                subclasses[iid] = [int(item) for item in values]
+                self.subclass_cache.put(iid, subclasses[iid], 8 * (len(values) + 1))
+        for int_ids in int_id_lists:
+            int_ids.extend(sub_id for iid in list(int_ids) for sub_id in subclasses[iid])
+        return int_id_lists
+
+class RedisBatch:
+    # A RedisBatch collects commands against any of the logical dbs and sends them with as few pipelines as the layout
+    # allows: one per redis db in the multidb layout, and a single one in the keyspace layout.
+    # Keys are given as they are in the logical db; the batch applies the layout.  execute() returns the results in
+    # the order that the commands were added.  The pipelines are sent concurrently, each on its own connection, so a
+    # batch over several dbs takes one round trip rather than one per db.
+    def __init__(self, rc):
+        self.rc = rc
+        self.pipelines = {}
+        # For each command, the pipeline it went to and its position in that pipeline
+        self.slots = []
+
+    def _pipeline(self, db):
+        client = self.rc.r[db]
+        if id(client) not in self.pipelines:
+            self.pipelines[id(client)] = [client.pipeline(transaction=False), 0]
+        entry = self.pipelines[id(client)]
+        self.slots.append((id(client), entry[1]))
+        entry[1] += 1
+        return entry[0]
+
+    def get(self, db, key):
+        self._pipeline(db).get(self.rc.key(db, key))
+
+    def lrange(self, db, key, start, end):
+        self._pipeline(db).lrange(self.rc.key(db, key), start, end)
+
+    def mget(self, db, keys):
+        keys = [self.rc.key(db, key) for key in keys]
+        if len(keys) == 0:
+            # MGET with no keys is an error in redis
+            self.slots.append((None, None))
+            return
+        self._pipeline(db).mget(keys)
+
+    async def execute(self):
+        client_ids = list(self.pipelines)
+        values = await asyncio.gather(*(self.pipelines[client_id][0].execute() for client_id in client_ids))
+        results = dict(zip(client_ids, values))
+        return [[] if client_id is None else results[client_id][i] for client_id, i in self.slots]
+
+class RedisLoadConnection:
+    # RedisLoadConnection is the synchronous connection used by the loader.  The loader is a single process writing
+    # in order, so it keeps one long-lived pipeline per db and flushes them periodically.  In the keyspace layout
+    # all 8 entries of get_pipelines() are the same db0 pipeline, and keys need to go through key().  slot is the
+    # blue/green copy of the database to write, as in RedisConnection.
+    # it is a context manager and can be used in a with statement
+    def __init__(self,host,port,password,layout=MULTIDB,slot=0):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout {layout}")
+        self.layout = layout
+        self.slot = slot
+        if layout == KEYSPACE:
+            self.r = [redis.StrictRedis(host=host, port=port, db=0, password=password, socket_connect_timeout=600)] * 8
+        else:
+            self.r = []
+            for i in range(8):
+                self.r.append(redis.StrictRedis(host=host, port=port, db=slot_db(slot, i), password=password,
+                                                socket_connect_timeout=600))
+        pipelines = {}
+        self.p = [ pipelines.setdefault(id(rc), rc.pipeline()) for rc in self.r ]
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush_pipelines()
+        for rc in {id(rc): rc for rc in self.r}.values():
+            rc.close()
+    def key(self, db, key):
+        return create_layout_key(self.layout, slot_db(self.slot, db), key)
+    def get_pipelines(self):
+        return self.p
+    def flush_pipelines(self):
+        for p in {id(p): p for p in self.p}.values():
+            p.execute()
+    def clear(self):
+        """Delete everything in this connection's slot, but not the blue/green pointer."""
+        if self.layout == KEYSPACE:
+            for db in range(8):
+                self.unlink_matching(self.r[db], create_layout_key(self.layout, slot_db(self.slot, db), "*"))
+        else:
+            for db, rc in enumerate(self.r):
+                if slot_db(self.slot, db) == 0:
+                    # Slot 0's db0 is also where the pointer lives, and the servers go on reading it while we load
+                    self.unlink_matching(rc, "*")
+                else:
+                    rc.flushdb()
+    @staticmethod
+    def unlink_matching(rc, pattern):
+        batch = []
+        for key in rc.scan_iter(match=pattern, count=10000):
+            if key == CURRENT_SLOT_KEY.encode():
+                continue
+            batch.append(key)
+            if len(batch) == 10000:
+                rc.unlink(*batch)
+                batch = []
+        if batch:
+            rc.unlink(*batch)
+    def sync(self):
+        """Make sure that everything sent so far is in redis."""
+        self.flush_pipelines()
+
+class RedisShardedLoadConnection:
+    # A drop-in for RedisLoadConnection that spreads the loader's writes over several connections, each written by its
+    # own thread, so that redis is kept busy while the loader works on the next records.  get_pipelines() returns
+    # stand-ins for the pipelines that send each command to a connection chosen by its key.  Every command for a key
+    # goes to the same connection, in order, so RPUSH and APPEND build exactly the same values as with one connection.
+    # flush_pipelines() hands the buffered commands to the threads without waiting for them to be written; the queues
+    # are bounded, so a loader that gets ahead of redis waits.  sync() waits for everything to be written.  Errors from
+    # the threads are raised at the next flush or sync.
+    def __init__(self, host, port, password, layout=MULTIDB, connections=4, slot=0):
+        self.layout = layout
+        self.slot = slot
+        self.shards = [RedisLoadConnection(host, port, password, layout, slot) for _ in range(connections)]
+        # For anything that isn't pipelined, like the metadata
+        self.r = self.shards[0].r
+        self.buffers = [[] for _ in self.shards]
+        self.queues = [queue.Queue(maxsize=4) for _ in self.shards]
+        self.errors = []
+        self.threads = [threading.Thread(target=self._write, args=(shard, q), daemon=True)
+                        for shard, q in zip(self.shards, self.queues)]
+        for thread in self.threads:
+            thread.start()
+        self.p = [ShardedPipeline(self, db) for db in range(8)]
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush_pipelines()
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+        for shard in self.shards:
+            shard.__exit__(exc_type, exc_val, exc_tb)
+        if self.errors and exc_type is None:
+            raise self.errors[0]
+    def key(self, db, key):
+        return create_layout_key(self.layout, slot_db(self.slot, db), key)
+    def get_pipelines(self):
+        return self.p
+    def clear(self):
+        self.shards[0].clear()
+    def flush_pipelines(self):
+        if self.errors:
+            raise self.errors[0]
+        for i, q in enumerate(self.queues):
+            if self.buffers[i]:
+                q.put(self.buffers[i])
+                self.buffers[i] = []
+    def sync(self):
+        """Make sure that everything sent so far is in redis."""
+        self.flush_pipelines()
+        for q in self.queues:
+            q.join()
+        if self.errors:
+            raise self.errors[0]
+    def add(self, db, command, key, args):
+        self.buffers[zlib.crc32(str(key).encode()) % len(self.shards)].append((db, command, key, args))
+    def _write(self, shard, q):
+        pipelines = shard.get_pipelines()
+        while True:
+            commands = q.get()
+            if commands is None:
+                q.task_done()
+                return
+            try:
+                for db, command, key, args in commands:
+                    getattr(pipelines[db], command)(key, *args)
+                shard.flush_pipelines()
+            except Exception as e:
+                self.errors.append(e)
+            q.task_done()
+
+class ShardedPipeline:
+    # The stand-in for one db's pipeline in RedisShardedLoadConnection.  It has the commands that the loader uses.
+    def __init__(self, rc, db):
+        self.rc = rc
+        self.db = db
+    def set(self, key, value):
+        self.rc.add(self.db, "set", key, (value,))
+    def rpush(self, key, *values):
+        self.rc.add(self.db, "rpush", key, values)
+    def append(self, key, value):
+        self.rc.add(self.db, "append", key, (value,))
+
+def create_resp_command(args):
+    # Encode one redis command in the redis protocol (RESP), as an array of bulk strings
+    out = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = b"%d" % arg
+        out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(out)
+
+class RedisExportConnection:
+    # A drop-in for RedisLoadConnection that, instead of sending the loader's commands to redis, writes them to a file
+    # in the redis protocol, so that a database can be built offline and then fed to any redis with
+    #   redis-cli --pipe < file
+    # Because it goes through the same loader code, the result is the same as loading live.  Like the pipelines, the
+    # commands are held per db until flush_pipelines(), which writes each db's commands after a SELECT.  The file is
+    # appended to, so that the node and edge loads can go into one file.  r and get_pipelines() are the same
+    # stand-ins, since nothing here is sent anywhere.
+    def __init__(self, path, layout=MULTIDB, slot=0):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout {layout}")
+        self.layout = layout
+        self.slot = slot
+        self.f = open(path, "ab")
+        self.buffers = [[] for _ in range(8)]
+        self.p = [ExportPipeline(self, db) for db in range(8)]
+        self.r = self.p
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush_pipelines()
+        self.f.close()
+    def key(self, db, key):
+        return create_layout_key(self.layout, slot_db(self.slot, db), key)
+    def get_pipelines(self):
+        return self.p
+    def flush_pipelines(self):
+        for db, buffer in enumerate(self.buffers):
+            if buffer:
+                # In the keyspace layout, write() has put everything under db 0
+                self.f.write(create_resp_command(["SELECT", db if self.layout == KEYSPACE else slot_db(self.slot, db)]))
+                self.f.write(b"".join(buffer))
+                buffer.clear()
+        self.f.flush()
+    def sync(self):
+        """Make sure that everything sent so far is in the file."""
+        self.flush_pipelines()
+    def write(self, db, *args):
+        if self.layout == KEYSPACE:
+            db = 0
+        self.buffers[db].append(create_resp_command(args))
+
+class ExportPipeline:
+    # The stand-in for one db's pipeline (or client) in RedisExportConnection.  It has the commands that the loader uses.
+    def __init__(self, rc, db):
+        self.rc = rc
+        self.db = db
+    def pipeline(self):
+        # The commands go into the file in order anyway
+        return self
+    def execute(self):
+        pass
+    def set(self, key, value):
+        self.rc.write(self.db, "SET", key, value)
+    def rpush(self, key, *values):
+        self.rc.write(self.db, "RPUSH", key, *values)
+    def append(self, key, value):
+        self.rc.write(self.db, "APPEND", key, value)
+
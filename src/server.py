@@ -1,18 +1,20 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 import os
+from typing import List
 from fastapi.middleware.cors import CORSMiddleware
 from reasoner_pydantic import Response as PDResponse, Result as PDResult, Analysis as PDAnalysis, KnowledgeGraph as PDKG
-from src.redis_connector import RedisConnection
-from src.descender import Descender
-from src.keymaster import create_trapi_pq
-from src.query_redis import squery, oquery, bquery
+from src.slots import Slots
+from src.keymaster import create_trapi_pq, create_query_graph_key, create_cursor, read_cursor
+from src.query_redis import gquery_ids, bquery_ids, gquery_ids_both_ways, bquery_ids_both_ways, gquery_counts, \
+    bquery_counts, gquery_ids_batch, get_cached_strings, Page
+from src.trapi_stream import stream_response
+from src.cache import LRUCache
 from fastapi import Request
-from fastapi.responses import ORJSONResponse
+from fastapi.responses import Response, StreamingResponse
 from pyinstrument import Profiler
 from pyinstrument.renderers.html import HTMLRenderer
 from pyinstrument.renderers.speedscope import SpeedscopeRenderer
 
-import orjson
 
 RTPF_VERSION = '0.0.1'
 
@@ -61,120 +63,235 @@ def register_profiling_middleware(app):
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD")
-rc = RedisConnection(
+# Upper bound on the redis connections the server opens, in all: it's split between the blue/green slots, and in the
+# multidb layout between the 8 dbs of each slot.  Concurrent queries beyond this wait for a free connection.
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "128"))
+# Must match the --layout that load_redis.py was run with
+REDIS_LAYOUT = os.environ.get("REDIS_LAYOUT", "multidb")
+# "python" or "lua".  The lua engine runs each one-hop as a script inside redis, and needs the keyspace layout.
+QUERY_ENGINE = os.environ.get("QUERY_ENGINE", "python")
+# Sizes in bytes of the in-process caches of node and edge strings.  0 turns a cache off.
+NODE_CACHE_BYTES = int(os.environ.get("NODE_CACHE_BYTES", "0"))
+EDGE_CACHE_BYTES = int(os.environ.get("EDGE_CACHE_BYTES", "0"))
+# Sizes in bytes of the in-process caches of curie -> int id and int id -> subclass ids.  0 turns a cache off.
+CURIE_CACHE_BYTES = int(os.environ.get("CURIE_CACHE_BYTES", "0"))
+SUBCLASS_CACHE_BYTES = int(os.environ.get("SUBCLASS_CACHE_BYTES", "0"))
+# Whole serialized responses are cached by query graph, up to RESPONSE_CACHE_BYTES (0 turns the cache off).  Entries
+# expire after RESPONSE_CACHE_TTL seconds, and are dropped when the loader writes a new generation, which is checked
+# every GENERATION_CHECK_SECONDS.
+RESPONSE_CACHE_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", "0"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+GENERATION_CHECK_SECONDS = float(os.environ.get("GENERATION_CHECK_SECONDS", "1"))
+# The loader can load into a second slot and switch the server over to it (see slots), so the connection and
+# Descender are looked up per request.
+slots = Slots(
     REDIS_HOST,
     REDIS_PORT,
-    REDIS_PASSWORD 
+    REDIS_PASSWORD,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    layout=REDIS_LAYOUT,
+    engine=QUERY_ENGINE,
+    node_cache_bytes=NODE_CACHE_BYTES,
+    edge_cache_bytes=EDGE_CACHE_BYTES,
+    curie_cache_bytes=CURIE_CACHE_BYTES,
+    subclass_cache_bytes=SUBCLASS_CACHE_BYTES,
+    generation_check=GENERATION_CHECK_SECONDS
     )
 
-descender = Descender(rc)
+response_cache = LRUCache(RESPONSE_CACHE_BYTES, ttl=RESPONSE_CACHE_TTL)
+
+@APP.on_event("startup")
+async def warm_descender():
+    # Pull the metadata from redis now, rather than making the first queries wait for it
+    seconds = await slots.warm()
+    if seconds is not None:
+        print(f"Loaded metadata in {seconds:.2f}s")
+
+@APP.on_event("shutdown")
+async def close_redis():
+    await slots.aclose()
+
+@APP.get("/cache_stats", tags=["Query"], status_code=200)
+async def cache_stats():
+    """ Sizes and hit/miss counts for the in-process caches. """
+    return {**slots.cache_stats(), "responses": response_cache.stats()}
 
 @APP.post("/query", tags=["Query"], status_code=200)
-async def query_handler(request: PDResponse):
+async def query_handler(request: PDResponse, stream: bool = False, limit: int = 0, cursor: str = None):
     #import cProfile
     #pr = cProfile.Profile()
     #pr.enable()
 
-    """ Query operations. """
+    """ Query operations.  With stream=true, the response is written out as it is built, which keeps memory flat and
+    gets the first bytes out early for very large answers.
+    With a limit, the response only has (up to) that many edges, and a top level "cursor".  Send the same query again
+    with that cursor to get the next page; the last page has a null cursor. """
+    query_graph = get_query_graph(request)
+    if limit < 0 or (cursor is not None and limit == 0):
+        raise HTTPException(status_code=400, detail="A cursor needs a positive limit")
+
+    # Everything below reads the same slot, even if the loader switches part way through
+    rc, descender = await slots.current()
+
+    page = None
+    if limit > 0:
+        page = Page(limit)
+        if cursor is not None:
+            # A cursor that's mangled, from another query or from before a load is the client's to fix
+            try:
+                page.pattern, page.offset = read_cursor(cursor, await rc.get_generation(), query_graph)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+    # If we've answered this query since the last load, just send the same answer.  The key has the generation in it,
+    # so entries from before a load can't be hit, and get pushed out by new ones.
+    if response_cache.max_bytes > 0:
+        cache_key = (await rc.get_generation(), create_query_graph_key(query_graph), limit, cursor)
+        content = response_cache.get(cache_key)
+        if content is not None:
+            return Response(status_code=200, content=content, media_type="application/json")
+
+    query_edge, subject_query_node, object_query_node = get_one_hop(query_graph)
+    subject_node = query_graph["nodes"][subject_query_node]
+    object_node = query_graph["nodes"][object_query_node]
+    pq = create_trapi_pq(query_graph["edges"][query_edge])
+    q_pred = query_graph["edges"][query_edge]["predicates"][0]
+
+    # Do the query
+    forward, reverse = await query_ids(subject_node, object_node, pq, q_pred, descender, rc, page)
+    next_cursor = None
+    if page is not None and page.next is not None:
+        next_cursor = create_cursor(await rc.get_generation(), query_graph, page.next)
+
+    # Create the response.  It's put together from the strings in redis without parsing them (see trapi_stream), and
+    # either streamed out as it goes or joined up here.
+    pieces = stream_response(query_graph, query_edge, subject_query_node, object_query_node, forward, reverse, rc,
+                             page is not None, next_cursor)
+    if stream:
+        return StreamingResponse(pieces, media_type="application/json")
+    content = b"".join([piece async for piece in pieces])
+
+    # after your program ends
+    #pr.disable()
+    #pr.print_stats(sort="cumtime")
+    if response_cache.max_bytes > 0:
+        response_cache.put(cache_key, content, len(content))
+    return Response(status_code=200,
+                    content=content,
+                    media_type="application/json")
+
+@APP.post("/count", tags=["Query"], status_code=200)
+async def count_handler(request: PDResponse):
+    """ How many edges (and so results) /query would return for the same request, without fetching them.  Returns
+    the total and the count for each query pattern (db5 key) that has any; a total of 0 means the answer is empty.
+    The counts are an upper bound: /query leaves out an edge that is missing from db4, or whose subject or object is
+    missing from db1, and finding those would mean fetching them. """
+    query_graph = get_query_graph(request)
+    rc, descender = await slots.current()
+    query_edge, subject_query_node, object_query_node = get_one_hop(query_graph)
+    subject_node = query_graph["nodes"][subject_query_node]
+    object_node = query_graph["nodes"][object_query_node]
+    pq = create_trapi_pq(query_graph["edges"][query_edge])
+    symmetric = await descender.is_symmetric(query_graph["edges"][query_edge]["predicates"][0])
+    if "ids" in subject_node and "ids" in object_node:
+        counts = await bquery_counts(subject_node["ids"], pq, object_node["ids"], descender, rc, symmetric)
+    elif "ids" in subject_node:
+        counts = await gquery_counts(subject_node["ids"], pq, object_node["categories"][0], True, descender, rc,
+                                     both_ways=symmetric)
+    else:
+        counts = await gquery_counts(object_node["ids"], pq, subject_node["categories"][0], False, descender, rc,
+                                     both_ways=symmetric)
+    return {"total": sum(counts.values()), "patterns": counts}
+
+@APP.post("/batch_query", tags=["Query"], status_code=200)
+async def batch_query_handler(requests: List[PDResponse]):
+    """ Run several one-hop queries in one call.  Returns a json list with the response to each, just as /query would
+    give it.  The queries share their redis work: all the curies are resolved together, all the patterns are read in
+    one pipeline, and each node and edge is only fetched once, however many of the responses it is in. """
+    query_graphs = [get_query_graph(request) for request in requests]
+    rc, descender = await slots.current()
+    generation = await rc.get_generation()
+
+    # Answers from the response cache don't need to be run at all
+    contents = [None] * len(query_graphs)
+    if response_cache.max_bytes > 0:
+        for i, query_graph in enumerate(query_graphs):
+            contents[i] = response_cache.get((generation, create_query_graph_key(query_graph), 0, None))
+    to_run = [i for i, content in enumerate(contents) if content is None]
+
+    queries = []
+    for i in to_run:
+        query_edge, subject_query_node, object_query_node = get_one_hop(query_graphs[i])
+        edge = query_graphs[i]["edges"][query_edge]
+        symmetric = await descender.is_symmetric(edge["predicates"][0])
+        queries.append(batch_query(query_graphs[i]["nodes"][subject_query_node],
+                                   query_graphs[i]["nodes"][object_query_node], create_trapi_pq(edge), symmetric))
+    results = await gquery_ids_batch(queries, descender, rc)
+
+    # Every node and edge for all of the responses, fetched together
+    node_ids = set()
+    edge_ids = set()
+    for forward, reverse in results:
+        for direction in (forward, reverse):
+            if direction is not None:
+                node_ids.update(direction[0].tolist())
+                edge_ids.update(direction[1].tolist())
+    strings = await get_cached_strings(rc, (1, node_ids, rc.node_cache), (4, edge_ids, rc.edge_cache))
+
+    for i, (forward, reverse) in zip(to_run, results):
+        query_edge, subject_query_node, object_query_node = get_one_hop(query_graphs[i])
+        pieces = stream_response(query_graphs[i], query_edge, subject_query_node, object_query_node, forward, reverse,
+                                 rc, strings=strings)
+        contents[i] = b"".join([piece async for piece in pieces])
+        if response_cache.max_bytes > 0:
+            response_cache.put((generation, create_query_graph_key(query_graphs[i]), 0, None), contents[i],
+                               len(contents[i]))
+    return Response(status_code=200, content=b"[" + b",".join(contents) + b"]", media_type="application/json")
+
+def batch_query(subject_node, object_node, pq, symmetric):
+    # The gquery_ids_batch query for a one-hop, choosing the input side as query_ids does
+    if "ids" in subject_node and "ids" in object_node:
+        # As bquery_ids
+        if len(subject_node["ids"]) < len(object_node["ids"]):
+            return subject_node["ids"], pq, "biolink:NamedThing", True, object_node["ids"], symmetric
+        return object_node["ids"], pq, "biolink:NamedThing", False, subject_node["ids"], symmetric
+    if "ids" in subject_node:
+        return subject_node["ids"], pq, object_node["categories"][0], True, None, symmetric
+    return object_node["ids"], pq, subject_node["categories"][0], False, None, symmetric
+
+def get_query_graph(request):
+    # Pull the query graph out of a request, and check it for basic validity
     dict_request = request.dict(exclude_unset=True, exclude_none=True)
-    # Check the query graph for basic validity
     query_graph = dict_request['message']['query_graph']
     if len(query_graph['edges']) != 1:
         raise ValueError("Only one edge is supported")
     if len(query_graph['nodes']) != 2:
         raise ValueError("Only two nodes are supported")
+    return query_graph
 
-    # Get the pq
-    query_edge = list(query_graph['edges'].keys())[0]
-    pq = create_trapi_pq(list(query_graph['edges'].values())[0])
+def get_one_hop(query_graph):
+    # Return the query edge id, and its subject and object query node ids
+    (query_edge, edge), = query_graph["edges"].items()
+    return query_edge, edge["subject"], edge["object"]
 
-    # Figure out if this is (subject, get object) or (object, get subject)
-    subject_query_node = query_graph["edges"][query_edge]["subject"]
-    object_query_node = query_graph["edges"][query_edge]["object"]
-    subject_node = query_graph["nodes"][subject_query_node]
-    object_node = query_graph["nodes"][object_query_node]
-
-    # Initialize reverse edges
-    input_nodes_r = []
-    output_nodes_r = []
-    edges_r = []
-    q_pred = list(query_graph['edges'].values())[0]["predicates"][0]
-
-    # Do the query
+async def query_ids(subject_node, object_node, pq, q_pred, descender, rc, page=None):
+    # Run the one-hop query, down to int ids only (see gquery_ids).  Returns the ids for the query as
+    # asked, and for the query turned around if the predicate is symmetric (otherwise None).  Both directions
+    # come from one pass over redis (see gquery_ids_both_ways).  With a Page, only that page comes back.
+    symmetric = await descender.is_symmetric(q_pred)
     if "ids" in subject_node and "ids" in object_node:
         subject_curies = subject_node["ids"]
         object_curies = object_node["ids"]
-        input_nodes, output_nodes, edges = await bquery(subject_curies, pq, object_curies, descender, rc)
-        # TODO: this is an opportunity for speedup because there is some duplicated work here.
-        if await descender.is_symmetric(q_pred):
-            output_nodes_r, input_nodes_r, edges_r = await bquery(object_curies, pq, subject_curies, descender, rc)
-    elif "ids" in subject_node:
-        subject_curies = subject_node["ids"]
-        input_nodes, output_nodes, edges = await oquery(subject_curies, pq, object_node["categories"][0], descender, rc)
-        if await descender.is_symmetric(q_pred):
-            output_nodes_r, input_nodes_r, edges_r = await squery(subject_curies, pq, object_node["categories"][0], descender, rc)
+        if symmetric:
+            return await bquery_ids_both_ways(subject_curies, pq, object_curies, descender, rc, page)
+        return await bquery_ids(subject_curies, pq, object_curies, descender, rc, page), None
+    if "ids" in subject_node:
+        input_curies, output_type, input_is_subject = subject_node["ids"], object_node["categories"][0], True
     else:
-        object_curies = object_node["ids"]
-        input_nodes, output_nodes, edges = await squery(object_curies, pq, subject_node["categories"][0], descender, rc)
-        if await descender.is_symmetric(q_pred):
-            output_nodes_r, input_nodes_r, edges_r = await oquery(object_curies, pq, subject_node["categories"][0], descender, rc)
-
-    # Merge the results, but we need to worry about duplicating nodes.  The edges are by construction
-    # pointing in the opposite directions, so there should be no overlap there.
-    if len(edges_r) > 0:
-        input_nodes = list(set(input_nodes + input_nodes_r))
-        output_nodes = list(set(output_nodes + output_nodes_r))
-        # Don't just merge the edge lists. We need to know which ones are pointing in the
-        # opposite direction so that we can create the correct node_bindings
-        # edges.extend(edges_r)
-
-    # Create edge identifiers
-    edge_id_to_edge = { f"knowledge_edge_{i}":orjson.loads(edge) for i, edge in enumerate(edges)}
-    # These edges are the ones that are going the same direction as the query
-    forward_edge_ids = set(edge_id_to_edge.keys())
-    # Now add the reverse edges. Make sure not to overwrite ids
-    edge_id_to_edge.update({ f"knowledge_edge_{i+len(edges)}":orjson.loads(edge) for i, edge in enumerate(edges_r)})
-
-    # Create the response
-    response = { "message" : { "query_graph": query_graph,
-                               "knowledge_graph": {"nodes":{}, "edges":{}},
-                               "results": [] } }
-
-    # KG Nodes
-    for nodelist in (input_nodes, output_nodes):
-        for node in nodelist:
-            # The node id is on the node in the redis, but it's invalid TRAPI to have it there, so we remove it
-            # now.  We could have removed it at load time, but then it's hard to recover because of the way that
-            # we are indexing.
-            jnode = orjson.loads(node)
-            nid = jnode["id"]
-            del jnode["id"]
-            response["message"]["knowledge_graph"]["nodes"][nid] = jnode
-
-    # KG Edges
-    response["message"]["knowledge_graph"]["edges"] = edge_id_to_edge
-
-    # Results
-    # Each edge is going to generate a result
-    for edge_id, edge in edge_id_to_edge.items():
-        analysis = {"resource_id":"infores:test",
-                    "edge_bindings":{query_edge: [{"id":edge_id}]}}
-        if edge_id in forward_edge_ids:
-            result = {"analyses":[analysis],
-                      "node_bindings":{subject_query_node:[{"id":edge["subject"]}],
-                                       object_query_node:[{"id":edge["object"]}]}}
-        else:
-            result = {"analyses":[analysis],
-                      "node_bindings":{subject_query_node:[{"id":edge["object"]}],
-                                       object_query_node:[{"id":edge["subject"]}]}}
-        response["message"]["results"].append(result)
-
-    # after your program ends
-    #pr.disable()
-    #pr.print_stats(sort="cumtime")
-    return ORJSONResponse(status_code=200,
-                        content=response,
-                        media_type="application/json")
+        input_curies, output_type, input_is_subject = object_node["ids"], subject_node["categories"][0], False
+    if symmetric:
+        return await gquery_ids_both_ways(input_curies, pq, output_type, input_is_subject, descender, rc, page=page)
+    return await gquery_ids(input_curies, pq, output_type, input_is_subject, descender, rc, page=page), None
 
 import uvicorn
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+# Blue/green switching for the server.  The loader can fill the slot that isn't being read (load_redis.py --switch)
+# and then flip the current_slot pointer in db0 (see keymaster.slot_db).  The server keeps a RedisConnection and a
+# Descender for each slot, and notices the flip the next time it checks the pointer.  Before it moves over, it warms
+# the new slot's Descender, so no query pays for pulling the metadata; after, it drops the old slot's caches.
+# Each request calls current() once, and uses that connection and Descender throughout, so a query that is running
+# when the pointer flips finishes against the slot it started on.
+
+import asyncio
+import time
+
+from src.redis_connector import RedisConnection
+from src.descender import Descender
+from src.keymaster import SLOTS
+
+
+class Slots:
+    def __init__(self, host, port, password, generation_check=1.0, max_connections=128, **kwargs):
+        """kwargs go to each slot's RedisConnection.  max_connections bounds the sockets for all of the slots
+        together, so each slot's RedisConnection gets its share.  The pointer is checked at most once every
+        generation_check seconds."""
+        self.connections = [RedisConnection(host, port, password, max(1, max_connections // SLOTS),
+                                            generation_check=generation_check, slot=slot, **kwargs)
+                            for slot in range(SLOTS)]
+        self.descenders = [Descender(rc) for rc in self.connections]
+        self.check_interval = generation_check
+        self.checked = None
+        self.slot = None
+        # Held while a new slot is being warmed, so only one request does it
+        self.switching = asyncio.Lock()
+
+    async def warm(self):
+        """Find the current slot and warm its Descender.  Returns how long the warming took, in seconds, or None if
+        the slot had no metadata to warm."""
+        self.slot = await self.connections[0].get_current_slot()
+        self.checked = time.monotonic()
+        return await self.descenders[self.slot].warm()
+
+    async def current(self):
+        """Return the (RedisConnection, Descender) for the current slot, switching first if the loader has flipped
+        the pointer since we last looked."""
+        now = time.monotonic()
+        if self.slot is None or now - self.checked >= self.check_interval:
+            self.checked = now
+            slot = await self.connections[0].get_current_slot()
+            if slot != self.slot:
+                await self.switch(slot)
+        return self.connections[self.slot], self.descenders[self.slot]
+
+    async def switch(self, slot):
+        async with self.switching:
+            # Someone else may have switched while we waited
+            if slot == self.slot:
+                return
+            seconds = await self.descenders[slot].warm()
+            old = self.slot
+            self.slot = slot
+            if seconds is None:
+                print(f"Switched to slot {slot}")
+            else:
+                print(f"Switched to slot {slot}, metadata loaded in {seconds:.2f}s")
+            if old is not None:
+                # The old slot is about to be cleared and reloaded, so nothing from it is any good now
+                self.connections[old].clear_caches()
+                self.connections[old].generation = None
+                self.descenders[old].reset()
+                self.descenders[old].generation = None
+
+    def cache_stats(self):
+        rc = self.connections[self.slot or 0]
+        return {"nodes": rc.node_cache.stats(), "edges": rc.edge_cache.stats(), "curies": rc.curie_cache.stats(),
+                "subclasses": rc.subclass_cache.stats()}
+
+    async def aclose(self):
+        for rc in self.connections:
+            await rc.aclose()
@@ -0,0 +1,150 @@
+# Writing TRAPI responses.  Rather than parsing every node and edge and building the whole response as a dict, the
+# response is put together as bytes, in pieces: the knowledge graph nodes, then the edges, then the results, pulling
+# the strings from redis a chunk at a time.  The server either streams the pieces or joins them.
+# The edge strings in db4 are already TRAPI, so they are spliced into the output as they are.  So are nodes loaded in
+# the fragment format (see keymaster); nodes in the json format still have to be parsed to take their ids off.
+# The results are bound from the int ids that came back with the edges (query_redis.gquery_ids), so the edges never
+# need to be parsed.  What stays in memory is the id arrays and a map from node int id to curie, not the strings.
+# The next chunk of strings is always being fetched while the current one is written out (see prefetched).
+
+import asyncio
+import re
+from itertools import chain
+
+import orjson
+
+from src.query_redis import get_cached_strings
+
+# How many nodes or edges to pull from redis in one MGET
+STREAM_CHUNK_SIZE = 10000
+
+# The json string that a node fragment starts with
+FRAGMENT_CURIE = re.compile(rb'"(?:[^"\\]|\\.)*"')
+
+
+def chunks(ids, size=STREAM_CHUNK_SIZE):
+    for start in range(0, len(ids), size):
+        # redis wants python ints, not numpy ones
+        yield ids[start:start + size].tolist()
+
+
+async def prefetched(rc, requests):
+    # Given an iterable of (db, ids, cache) requests, yield (ids, strings) for each in turn, the strings from
+    # get_cached_strings, with the next one already on its way from redis while the caller works on this one.
+    task = None
+    try:
+        for request in requests:
+            next_task = asyncio.ensure_future(get_cached_strings(rc, request))
+            if task is not None:
+                (strings,) = await task
+                yield ids, strings
+            ids, task = request[1], next_task
+        if task is not None:
+            (strings,) = await task
+            task = None
+            yield ids, strings
+    finally:
+        # If the caller stops early (say, a streaming client went away), don't leave a fetch running
+        if task is not None:
+            task.cancel()
+
+
+async def looked_up(strings, requests):
+    # Like prefetched, but from a (node strings, edge strings) pair of dictionaries that were fetched beforehand
+    for db, ids, _ in requests:
+        found = strings[0] if db == 1 else strings[1]
+        yield ids, {i: found[i] for i in ids if i in found}
+
+
+def node_fragment(node_string):
+    # Given a node from db1 in either format, return (the curie as json, the node as a knowledge_graph fragment)
+    if node_string[:1] == b'"':
+        return FRAGMENT_CURIE.match(node_string).group(), node_string
+    node = orjson.loads(node_string)
+    curie = orjson.dumps(node.pop("id"))
+    return curie, curie + b":" + orjson.dumps(node)
+
+
+async def stream_response(query_graph, query_edge, subject_query_node, object_query_node, forward, reverse, rc,
+                          paged=False, cursor=None, strings=None):
+    # Generate the bytes of a TRAPI response.  forward and reverse are the (node_ids, edge_ids, edge_subject_ids,
+    # edge_object_ids) from gquery_ids, for the query as asked and (if the predicate is symmetric) for the query
+    # turned around; reverse can be None.  Knowledge edges are numbered forward first, then reverse, and each edge
+    # gets one result.  Nodes and edges go through rc.node_cache and rc.edge_cache.
+    # If paged, the response also gets a top level "cursor" for the next page (null for the last page).
+    # strings, if given, is a (node strings, edge strings) pair of dictionaries by int id that have already been
+    # fetched, and redis isn't asked for anything.
+    directions = [forward] if reverse is None else [forward, reverse]
+
+    yield b'{"message":{"query_graph":' + orjson.dumps(query_graph) + b',"knowledge_graph":{"nodes":{'
+
+    # KG Nodes.  Nodes can come back from both directions, but the KG nodes are keyed on the curie so they
+    # can't be duplicated.
+    node_ids = set()
+    for direction in directions:
+        node_ids.update(direction[0].tolist())
+    node_ids = sorted(node_ids)
+    node_chunks = [node_ids[start:start + STREAM_CHUNK_SIZE] for start in range(0, len(node_ids), STREAM_CHUNK_SIZE)]
+    # Nodes and edges are all fetched in one prefetched sequence, so the first edges are on their way while the
+    # last nodes are written
+    requests = chain(((1, chunk, rc.node_cache) for chunk in node_chunks),
+                     ((4, chunk, rc.edge_cache) for direction in directions for chunk in chunks(direction[1])))
+    fetches = prefetched(rc, requests) if strings is None else looked_up(strings, requests)
+    curies = {}
+    separator = b""
+    for _ in node_chunks:
+        chunk, node_strings = await fetches.__anext__()
+        out = []
+        for node_id in chunk:
+            if node_id in node_strings:
+                curies[node_id], fragment = node_fragment(node_strings[node_id])
+                out.append(separator + fragment)
+                separator = b","
+        yield b"".join(out)
+
+    # KG Edges, straight from db4.  Remember any that are missing, or whose subject or object node is, so they don't
+    # get a result.  The ends come in the same chunks as the edges.
+    yield b'},"edges":{'
+    missing = set()
+    separator = b""
+    edge_number = 0
+    ends = chain.from_iterable(zip(chunks(direction[2]), chunks(direction[3])) for direction in directions)
+    async for chunk, edge_strings in fetches:
+        subject_chunk, object_chunk = next(ends)
+        out = []
+        for edge_id, subject_id, object_id in zip(chunk, subject_chunk, object_chunk):
+            if edge_id in edge_strings and subject_id in curies and object_id in curies:
+                out.append(separator + b'"knowledge_edge_%d":' % edge_number + edge_strings[edge_id])
+                separator = b","
+            else:
+                missing.add(edge_number)
+            edge_number += 1
+        yield b"".join(out)
+
+    # Results.  Each edge is going to generate a result.  The reverse edges point in the opposite direction from the
+    # query edge, so their subjects bind to the query's object node.
+    yield b'}},"results":['
+    result_start = b'{"analyses":[{"resource_id":"infores:test","edge_bindings":{' + orjson.dumps(query_edge) + \
+                   b':[{"id":"knowledge_edge_'
+    subject_binding = b'"}]}}],"node_bindings":{' + orjson.dumps(subject_query_node) + b':[{"id":'
+    object_binding = b'}],' + orjson.dumps(object_query_node) + b':[{"id":'
+    result_end = b'}]}}'
+    separator = b""
+    edge_number = 0
+    for reverse_direction, (_, edge_ids, subject_ids, object_ids) in enumerate(directions):
+        if reverse_direction:
+            subject_ids, object_ids = object_ids, subject_ids
+        for subject_chunk, object_chunk in zip(chunks(subject_ids), chunks(object_ids)):
+            out = []
+            for subject_id, object_id in zip(subject_chunk, object_chunk):
+                if edge_number not in missing:
+                    out.append(separator + result_start + b"%d" % edge_number +
+                               subject_binding + curies[subject_id] +
+                               object_binding + curies[object_id] + result_end)
+                    separator = b","
+                edge_number += 1
+            yield b"".join(out)
+    if paged:
+        yield b']},"cursor":' + orjson.dumps(cursor) + b"}"
+    else:
+        yield b"]}}"
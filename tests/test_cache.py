@@ -0,0 +1,33 @@
+from src.cache import LRUCache
+
+def test_lru_eviction():
+    c = LRUCache(10)
+    c.put("a", 1, 4)
+    c.put("b", 2, 4)
+    # Touch a so that b is the least recently used
+    assert c.get("a") == 1
+    c.put("c", 3, 4)
+    assert c.get("b") is None
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+    assert c.bytes == 8
+    assert c.hits == 3
+    assert c.misses == 1
+
+def test_oversized_and_disabled():
+    c = LRUCache(10)
+    c.put("a", 1, 11)
+    assert len(c) == 0
+    c = LRUCache(0)
+    c.put("a", 1, 1)
+    assert c.get("a") is None
+    assert c.misses == 0
+
+def test_ttl():
+    c = LRUCache(10, ttl=-1)
+    c.put("a", 1, 4)
+    assert c.get("a") is None
+    assert c.bytes == 0
+    c = LRUCache(10, ttl=60)
+    c.put("a", 1, 4)
+    assert c.get("a") == 1
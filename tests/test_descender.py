@@ -9,3 +9,121 @@ def test_deepest_types():
     typelist = ["biolink:MacromolecularMachineMixin","biolink:GenomicEntity","biolink:PhysicalEssenceOrOccurrent","biolink:Gene","biolink:Protein","biolink:BiologicalEntity","biolink:Polypeptide","biolink:ChemicalEntityOrGeneOrGeneProduct","biolink:ChemicalEntityOrProteinOrPolypeptide","biolink:Entity","biolink:OntologyClass","biolink:GeneOrGeneProduct","biolink:ThingWithTaxon","biolink:NamedThing","biolink:GeneProductMixin","biolink:PhysicalEssence"]
     assert dec.get_deepest_types(typelist) == ["biolink:Gene", "biolink:Protein"]
 
+
+def test_index_partial_patterns():
+    from src.descender import index_partial_patterns
+    index = index_partial_patterns([(5, 1), (5, 2), (7, 1)])
+    assert index == {5: {1, 2}, 7: {1}}
+
+
+def test_warm_without_metadata():
+    # A server can start before anything is loaded.  Warming then does nothing, and the first query loads the metadata.
+    import asyncio
+    class EmptyRedis:
+        async def exists(self, *keys):
+            return 0
+        async def get(self, key):
+            return None
+    class EmptyConnection:
+        r = [EmptyRedis()] * 8
+        def key(self, db, key):
+            return key
+    descender = Descender(EmptyConnection())
+    assert asyncio.run(descender.warm()) is None
+    assert descender.metadata_version is None and descender.s_partial_patterns is None
+
+
+class GatedRedis:
+    # Stands in for the db7 client: metadata from a dict, counting the reads, which wait until the gate is open
+    def __init__(self, values):
+        import asyncio
+        self.values = values
+        self.gets = {}
+        self.gate = asyncio.Event()
+    async def exists(self, *keys):
+        return sum(key in self.values for key in keys)
+    async def get(self, key):
+        self.gets[key] = self.gets.get(key, 0) + 1
+        await self.gate.wait()
+        return self.values.get(key)
+
+
+class GatedConnection:
+    # A RedisConnection with one loaded generation: types 1 and 2, pqs 3 and 4, and only (pq 3, type 1) in the db
+    def __init__(self):
+        import msgpack
+        from src.keymaster import create_partial_pattern_array
+        self.r = [GatedRedis({"metadata_version": b"2",
+                              "pq_to_descendants": msgpack.packb({"p": ["p", "q"]}),
+                              "type_to_descendants": msgpack.packb({"T": ["T", "U"], "U": ["U"]}),
+                              "s_partial_patterns": create_partial_pattern_array({(3, 1)}),
+                              "o_partial_patterns": create_partial_pattern_array(set()),
+                              "predicate_symmetries": msgpack.packb({"p": False})})] * 8
+        self.ids = {2: {"T": 1, "U": 2}, 3: {"p": 3, "q": 4}}
+    def key(self, db, key):
+        return key
+    async def get_generation(self):
+        return b"1"
+    async def pipeline_gets(self, db, keys, convert_to_int=True):
+        await self.r[7].gate.wait()
+        return {key: self.ids[db][key] for key in keys if key in self.ids[db]}
+
+
+def test_shared_plan():
+    # Cold callers asking for the same plan at once share one build, and each piece of metadata is read once
+    import asyncio
+    async def plans():
+        rc = GatedConnection()
+        descender = Descender(rc)
+        calls = [asyncio.ensure_future(descender.get_expansion_plan("p", "T", True)) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        rc.r[7].gate.set()
+        return rc, descender, await asyncio.gather(*calls)
+    rc, descender, results = asyncio.run(plans())
+    assert results == [[(3, 1)]] * 5
+    assert descender.expansion_plans == {("p", "T", True): [(3, 1)]}
+    assert set(rc.r[7].gets.values()) == {1}
+
+
+def test_reset_during_load():
+    # A load that was started before a reset finishes for its caller, but isn't kept, as it may be from the old
+    # generation.  The next caller loads again.
+    import asyncio
+    async def plans():
+        rc = GatedConnection()
+        descender = Descender(rc)
+        call = asyncio.ensure_future(descender.get_expansion_plan("p", "T", True))
+        await asyncio.sleep(0.01)
+        descender.reset()
+        rc.r[7].gate.set()
+        before = await call
+        assert descender.expansion_plans == {} and descender.s_partial_patterns is None
+        assert await descender.get_expansion_plan("p", "T", True) == before == [(3, 1)]
+        return rc, descender
+    rc, descender = asyncio.run(plans())
+    assert descender.expansion_plans == {("p", "T", True): [(3, 1)]}
+    assert rc.r[7].gets["s_partial_patterns"] == 2
+
+
+def test_reset_during_warm():
+    # warm() shares its loads with a query that comes in at the same time, and keeps none of them after a reset
+    import asyncio
+    async def warming():
+        rc = GatedConnection()
+        descender = Descender(rc)
+        warm = asyncio.ensure_future(descender.warm())
+        plan = asyncio.ensure_future(descender.get_expansion_plan("p", "T", True))
+        await asyncio.sleep(0.01)
+        # Up to the reset, nothing was read twice
+        assert set(rc.r[7].gets.values()) == {1}
+        descender.reset()
+        rc.r[7].gate.set()
+        await asyncio.gather(warm, plan)
+        return rc, descender
+    rc, descender = asyncio.run(warming())
+    # What was in flight at the reset isn't kept.  (Reads that only started after it, such as the plan's type
+    # descendants and the metadata version, are from the new generation, and are.)
+    for name in ["s_partial_patterns", "o_partial_patterns", "pattern_format", "predicate_is_symmetric",
+                 "pq_to_descendant_int_ids", "type_int_ids"]:
+        assert getattr(descender, name) is None, name
+    assert descender.expansion_plans == {}
@@ -0,0 +1,39 @@
+from src.redis_connector import RedisExportConnection, create_resp_command
+from src.keymaster import KEYSPACE
+
+
+def test_resp_command():
+    assert create_resp_command(["SET", "CHEBI:1", 12]) == b"*3\r\n$3\r\nSET\r\n$7\r\nCHEBI:1\r\n$2\r\n12\r\n"
+    assert create_resp_command(["APPEND", "1,2,3", b"\x00\r\n"]) == \
+        b"*3\r\n$6\r\nAPPEND\r\n$5\r\n1,2,3\r\n$3\r\n\x00\r\n\r\n"
+
+
+def test_export(tmp_path):
+    # Commands are grouped by db, each group after a SELECT
+    path = tmp_path / "out.resp"
+    with RedisExportConnection(path) as rc:
+        pipelines = rc.get_pipelines()
+        pipelines[0].set(rc.key(0, "CHEBI:1"), 1)
+        pipelines[5].rpush(rc.key(5, "1,1,0"), 1, 2)
+        pipelines[0].set(rc.key(0, "CHEBI:2"), 2)
+        rc.r[7].set(rc.key(7, "layout"), rc.layout)
+    assert path.read_bytes() == b"".join(create_resp_command(c) for c in [
+        ["SELECT", 0], ["SET", "CHEBI:1", 1], ["SET", "CHEBI:2", 2],
+        ["SELECT", 5], ["RPUSH", "1,1,0", 1, 2],
+        ["SELECT", 7], ["SET", "layout", "multidb"]])
+    # Appending, in the keyspace layout
+    with RedisExportConnection(path, KEYSPACE) as rc:
+        rc.get_pipelines()[5].append(rc.key(5, "1,1,0"), b"x")
+    assert path.read_bytes().endswith(create_resp_command(["SELECT", 0]) + create_resp_command(["APPEND", "5:1,1,0", b"x"]))
+
+
+def test_export_slot(tmp_path):
+    # The second blue/green slot lives 8 dbs up in the multidb layout, but shares db0 in the keyspace layout
+    path = tmp_path / "out.resp"
+    with RedisExportConnection(path, slot=1) as rc:
+        rc.get_pipelines()[5].append(rc.key(5, "1,1,0"), b"x")
+    with RedisExportConnection(path, KEYSPACE, slot=1) as rc:
+        rc.get_pipelines()[5].append(rc.key(5, "1,1,0"), b"x")
+    assert path.read_bytes() == b"".join(create_resp_command(c) for c in [
+        ["SELECT", 13], ["APPEND", "1,1,0", b"x"],
+        ["SELECT", 0], ["APPEND", "13:1,1,0", b"x"]])
@@ -0,0 +1,182 @@
+# Loader tests.  These don't need a redis server: the loader writes to fakeredis (installed for the tests along with
+# pytest), or to an export file, and the keys that come out are compared.  load_redis.py is run as a script from
+# src/, so it's imported the same way here.
+
+import json
+import os
+import sys
+
+import fakeredis
+import pytest
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import load_redis
+from src.keymaster import create_pq, CURRENT_SLOT_KEY, MULTIDB, KEYSPACE, LIST_PATTERNS, PACKED_PATTERNS
+
+TYPES = ["biolink:NamedThing", "biolink:SmallMolecule", "biolink:Gene"]
+AFFECTS = create_pq({"predicate": "biolink:affects"})
+RELATED = create_pq({"predicate": "biolink:related_to"})
+SUBCLASS = create_pq({"predicate": "biolink:subclass_of"})
+
+
+class StubDescender:
+    # Just enough of a Descender for the loader, without going to bmt
+    def __init__(self):
+        self.type_to_descendants = {"biolink:NamedThing": TYPES, "biolink:SmallMolecule": ["biolink:SmallMolecule"],
+                                    "biolink:Gene": ["biolink:Gene"]}
+        self.pq_to_descendants = {RELATED: {RELATED, AFFECTS, SUBCLASS}, AFFECTS: {AFFECTS}, SUBCLASS: {SUBCLASS}}
+        self.predicate_is_symmetric = {"biolink:related_to": True, "biolink:affects": False,
+                                       "biolink:subclass_of": False}
+
+    def get_deepest_types(self, typelist):
+        return [t for t in typelist if t != "biolink:NamedThing"]
+
+
+def write_kg(path, chemicals=6, genes=4):
+    # A little graph of chemicals, some subclasses of others, affecting genes
+    nodes = [{"id": f"CHEBI:{i}", "category": ["biolink:SmallMolecule", "biolink:NamedThing"], "name": f"chem{i}"}
+             for i in range(1, chemicals + 1)]
+    nodes += [{"id": f"NCBIGene:{i}", "category": ["biolink:Gene", "biolink:NamedThing"], "name": f"gene{i}"}
+              for i in range(1, genes + 1)]
+    edges = [{"subject": f"CHEBI:{i}", "predicate": "biolink:subclass_of", "object": f"CHEBI:{i // 2}"}
+             for i in range(2, chemicals + 1)]
+    edges += [{"subject": f"CHEBI:{i}", "predicate": "biolink:affects", "object": f"NCBIGene:{i % genes + 1}"}
+              for i in range(1, chemicals + 1)]
+    edges += [{"subject": f"NCBIGene:{i}", "predicate": "biolink:related_to", "object": f"CHEBI:{i}"}
+              for i in range(1, genes + 1)]
+    for name, records in (("nodes", nodes), ("edges", edges)):
+        with open(path / f"{name}.jsonl", "w") as f:
+            f.writelines(json.dumps(r) + "\n" for r in records)
+    return path / "nodes.jsonl", path / "edges.jsonl"
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # Every connection the loader makes goes to the same fake server
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis, "StrictRedis",
+                        lambda *args, db=0, **kwargs: fakeredis.FakeStrictRedis(server=server, db=db))
+    return server
+
+
+def dump(server, dbs=range(16)):
+    # Everything in the given redis dbs, except the generation stamps, which change with every load
+    keys = {}
+    for db in dbs:
+        r = fakeredis.FakeStrictRedis(server=server, db=db)
+        for key in r.keys():
+            if key.endswith(b"generation"):
+                continue
+            keys[(db, key)] = r.lrange(key, 0, -1) if r.type(key) == b"list" else r.get(key)
+    return keys
+
+
+def load(nodepath, edgepath, append=False, **kwargs):
+    # load_nodes and load_edges, with whichever of the options each one takes
+    descender = StubDescender()
+    node_kwargs = {k: v for k, v in kwargs.items() if k != "pattern_format"}
+    categories, intnodeids = load_redis.load_nodes(nodepath, descender, "h", 0, "p", append=append, **node_kwargs)
+    load_redis.load_edges(edgepath, descender, categories, intnodeids, "h", 0, "p", append=append, **kwargs)
+
+
+def split(path, nodepath, edgepath):
+    # The graph as two loads: the first half of the nodes with the edges among them, then the rest
+    nodes = nodepath.read_text().splitlines(keepends=True)
+    edges = edgepath.read_text().splitlines(keepends=True)
+    first = {json.loads(n)["id"] for n in nodes[:len(nodes) // 2]}
+    first_edges = [e for e in edges if json.loads(e)["subject"] in first and json.loads(e)["object"] in first]
+    parts = [(nodes[:len(nodes) // 2], first_edges),
+             (nodes[len(nodes) // 2:], [e for e in edges if e not in first_edges])]
+    paths = []
+    for i, (part_nodes, part_edges) in enumerate(parts):
+        paths.append((path / f"nodes{i}.jsonl", path / f"edges{i}.jsonl"))
+        paths[-1][0].write_text("".join(part_nodes))
+        paths[-1][1].write_text("".join(part_edges))
+    return paths
+
+
+@pytest.mark.parametrize("layout", [MULTIDB, KEYSPACE])
+@pytest.mark.parametrize("pattern_format", [LIST_PATTERNS, PACKED_PATTERNS])
+def test_append(server, tmp_path, layout, pattern_format):
+    # Loading the graph in two parts, the second with append, gives the same database as loading it all at once
+    nodepath, edgepath = write_kg(tmp_path)
+    load(nodepath, edgepath, layout=layout, pattern_format=pattern_format)
+    full = dump(server)
+    fakeredis.FakeStrictRedis(server=server).flushall()
+    (nodes0, edges0), (nodes1, edges1) = split(tmp_path, nodepath, edgepath)
+    load(nodes0, edges0, layout=layout, pattern_format=pattern_format)
+    load(nodes1, edges1, append=True, layout=layout, pattern_format=pattern_format)
+    assert dump(server) == full
+
+
+@pytest.mark.parametrize("layout", [MULTIDB, KEYSPACE])
+def test_switch(server, monkeypatch, tmp_path, layout):
+    # Two switches, 0->1->0.  The second one clears slot 0, which in the multidb layout shares redis db0 with the
+    # pointer, and the servers are reading the pointer all through the load.
+    monkeypatch.setattr(load_redis, "Descender", StubDescender)
+    pointer = fakeredis.FakeStrictRedis(server=server, db=0)
+    seen = []
+    load_nodes = load_redis.load_nodes
+    def watched_load_nodes(*args, **kwargs):
+        seen.append(pointer.get(CURRENT_SLOT_KEY))
+        return load_nodes(*args, **kwargs)
+    monkeypatch.setattr(load_redis, "load_nodes", watched_load_nodes)
+    nodepath, edgepath = write_kg(tmp_path)
+    load_redis.load(nodepath, edgepath, "h", 0, "p", layout)
+    loaded = dump(server)
+    load_redis.load(nodepath, edgepath, "h", 0, "p", layout, switch=True)
+    assert pointer.get(CURRENT_SLOT_KEY) == b"1"
+    load_redis.load(nodepath, edgepath, "h", 0, "p", layout, switch=True)
+    assert pointer.get(CURRENT_SLOT_KEY) == b"0"
+    # While each slot was loading, the servers could still see which slot to read
+    assert seen == [None, None, b"1"]
+    # Slot 0 was cleared and loaded again, and came out the same, apart from the pointer
+    reloaded = dump(server)
+    del reloaded[(0, CURRENT_SLOT_KEY.encode())]
+    assert {k: v for k, v in reloaded.items() if k in loaded} == loaded
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Small enough that the little graph is split over several chunks and pattern windows
+    monkeypatch.setattr(load_redis.read_chunks, "__defaults__", (3,))
+    monkeypatch.setattr(load_redis, "PATTERN_WINDOW", 5)
+
+
+@pytest.mark.parametrize("layout", [MULTIDB, KEYSPACE])
+def test_parallel(server, small_chunks, tmp_path, layout):
+    # Preparing records in worker processes and writing over several connections gives the same keys as doing both
+    # one at a time
+    nodepath, edgepath = write_kg(tmp_path, chemicals=20, genes=7)
+    load(nodepath, edgepath, layout=layout)
+    serial = dump(server)
+    fakeredis.FakeStrictRedis(server=server).flushall()
+    load(nodepath, edgepath, layout=layout, processes=2, connections=3)
+    assert dump(server) == serial
+
+
+def test_parallel_export(small_chunks, monkeypatch, tmp_path):
+    # As test_parallel, for the export file, which should be the same byte for byte once the generation stamps are
+    monkeypatch.setattr(load_redis.uuid, "uuid4", lambda: load_redis.uuid.UUID(int=0))
+    nodepath, edgepath = write_kg(tmp_path, chemicals=20, genes=7)
+    exports = []
+    for processes in [0, 2]:
+        exports.append(tmp_path / f"out{processes}.resp")
+        exports[-1].write_bytes(b"")
+        load(nodepath, edgepath, export=exports[-1], processes=processes)
+    assert exports[0].read_bytes() == exports[1].read_bytes() != b""
+
+
+@pytest.mark.parametrize("layout", [MULTIDB, KEYSPACE])
+@pytest.mark.parametrize("pattern_format", [LIST_PATTERNS, PACKED_PATTERNS])
+def test_pattern_window(server, monkeypatch, tmp_path, layout, pattern_format):
+    # The pattern pushes are gathered up over PATTERN_WINDOW edges, and however small the window, the patterns come
+    # out the same as with the default
+    nodepath, edgepath = write_kg(tmp_path, chemicals=20, genes=7)
+    load(nodepath, edgepath, layout=layout, pattern_format=pattern_format)
+    whole = dump(server)
+    fakeredis.FakeStrictRedis(server=server).flushall()
+    monkeypatch.setattr(load_redis, "PATTERN_WINDOW", 2)
+    load(nodepath, edgepath, layout=layout, pattern_format=pattern_format)
+    assert dump(server) == whole
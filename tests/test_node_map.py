@@ -0,0 +1,75 @@
+import pytest
+
+import src.node_map
+from src.node_map import CurieMap, CategoryColumn, ChainedMap, SubclassIndex
+
+
+def fill(curies):
+    curie_map = CurieMap()
+    for int_id, curie in enumerate(curies, start=1):
+        curie_map[curie] = int_id
+    curie_map.finish(lambda: iter(curies))
+    return curie_map
+
+
+def test_curie_map():
+    curies = [f"CHEBI:{i}" for i in range(1000)] + ["CHEBI:5"]
+    curie_map = fill(curies)
+    assert curie_map["CHEBI:0"] == 1
+    assert curie_map["CHEBI:999"] == 1000
+    # Like a dict, the later id wins
+    assert curie_map["CHEBI:5"] == 1001
+    with pytest.raises(KeyError):
+        curie_map["CHEBI:1000"]
+
+
+def test_curie_map_collisions(monkeypatch):
+    # With a hash this bad, almost everything collides, and the map has to fall back on the curies themselves
+    monkeypatch.setattr(src.node_map, "hash_curie", lambda curie: len(curie))
+    curies = ["A:1", "A:2", "A:10", "B:100"]
+    curie_map = fill(curies)
+    assert [curie_map[c] for c in curies] == [1, 2, 3, 4]
+    assert "B:100" not in curie_map.collisions
+
+
+def test_category_column():
+    column = CategoryColumn()
+    for category_ids in ([0], [], [1, 2]):
+        column.append(category_ids)
+    column.finish()
+    assert len(column) == 3
+    assert column[1] == [0]
+    assert column[2] == []
+    assert column[3] == [1, 2]
+    assert column.get(4, []) == []
+    with pytest.raises(KeyError):
+        column[0]
+    # Starting from somewhere else, as in an incremental load
+    column = CategoryColumn(first_id=11)
+    column.append([3])
+    column.finish()
+    assert column.get(10) is None
+    assert column[11] == [3]
+    # Falling back on the nodes that were there before
+    chained = ChainedMap(column, {5: [1]})
+    assert chained[11] == [3]
+    assert chained.get(5, []) == [1]
+    assert chained.get(6, []) == []
+    with pytest.raises(KeyError):
+        chained[6]
+
+
+def test_subclass_index():
+    # 1 <- 2 <- 4 <- 6, 1 <- 3, 2 <- 5, and a cycle 7 <-> 8
+    subclasses = SubclassIndex()
+    for parent, child in [(1, 2), (1, 3), (2, 4), (2, 5), (4, 6), (7, 8), (8, 7)]:
+        subclasses.add(parent, child)
+    subclasses.finish()
+    assert subclasses.roots() == [1, 2, 4, 7, 8]
+    # Breadth first, so the cap cuts off the deepest
+    assert subclasses.closure(1, 100) == [2, 3, 4, 5, 6]
+    assert subclasses.closure(1, 3) == [2, 3, 4]
+    assert subclasses.closure(6, 100) == []
+    assert subclasses.closure(7, 100) == [8]
+    assert subclasses.ancestors([4]) == {1, 2, 4}
+    assert subclasses.ancestors([7]) == {7, 8}
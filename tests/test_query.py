@@ -2,13 +2,15 @@
 # python src/load_redis.py nodes.jsonl edges.jsonl 127.0.0.1 6379 nop
 # Where nodes.jsonl and edges.jsonl are from gtopdb
 
+import asyncio
 import json
 
 import pytest
 
 from src.redis_connector import RedisConnection
-from src.keymaster import create_pq
-from src.query_redis import squery, oquery, bquery
+from src.keymaster import create_pq, create_node_fragment, create_cursor, read_cursor, create_query_graph_key
+from src.query_redis import squery, oquery, bquery, gquery_ids, gquery_ids_both_ways, gquery_counts
+from src.trapi_stream import node_fragment, stream_response
 from src.descender import Descender
 
 # TODO : make rc, Desc into fixtures
@@ -85,6 +87,56 @@ def test_no_results_query(rc, descender):
     assert len(output_nodes) == 0
     assert len(edges) == 0
 
+def test_curie_cache():
+    # CHEBI:87633 has two subclasses (see test_subclass).  The second lookup, including the curie that isn't there,
+    # comes straight from the caches.
+    rc = RedisConnection("localhost", 6379, "", curie_cache_bytes=10000, subclass_cache_bytes=10000)
+    async def lookups():
+        first = await rc.get_int_node_ids(["CHEBI:87633"], ["FAKE:ID"])
+        second = await rc.get_int_node_ids(["CHEBI:87633"], ["FAKE:ID"])
+        await rc.aclose()
+        return first, second
+    first, second = asyncio.run(lookups())
+    assert len(first[0]) == 3
+    assert first[1] == []
+    assert second == first
+    assert rc.curie_cache.hits == 2
+    assert rc.subclass_cache.hits == 1
+
+def test_both_ways():
+    # One pass in both directions gives the same as a query each way
+    rc = RedisConnection("localhost", 6379, "")
+    descender = Descender(rc)
+    pq = create_pq({"predicate": "biolink:related_to"})
+    curies = ["PUBCHEM.COMPOUND:60795", "NCBIGene:3356"]
+    async def queries():
+        both = await gquery_ids_both_ways(curies, pq, "biolink:NamedThing", True, descender, rc)
+        forward = await gquery_ids(curies, pq, "biolink:NamedThing", True, descender, rc)
+        reverse = await gquery_ids(curies, pq, "biolink:NamedThing", False, descender, rc)
+        await rc.aclose()
+        return both, (forward, reverse)
+    both, separate = asyncio.run(queries())
+    assert len(both[0][1]) > 0 and len(both[1][1]) > 0
+    for together, alone in zip(both, separate):
+        for ids, expected in zip(together, alone):
+            assert ids.tolist() == expected.tolist()
+
+def test_counts():
+    # The counts add up to the edges that the query finds, with and without a filter
+    rc = RedisConnection("localhost", 6379, "")
+    descender = Descender(rc)
+    pq = create_pq({"predicate": "biolink:affects"})
+    async def queries():
+        counts = await gquery_counts(["PUBCHEM.COMPOUND:60795"], pq, "biolink:Gene", True, descender, rc)
+        filtered = await gquery_counts(["PUBCHEM.COMPOUND:60795"], pq, "biolink:Gene", True, descender, rc,
+                                       ["NCBIGene:3356"])
+        edges = await gquery_ids(["PUBCHEM.COMPOUND:60795"], pq, "biolink:Gene", True, descender, rc)
+        await rc.aclose()
+        return counts, filtered, edges
+    counts, filtered, edges = asyncio.run(queries())
+    assert sum(counts.values()) == len(edges[1]) == 2
+    assert sum(filtered.values()) == 1
+
 def run_basic_tests(rc, descender, subject_type=None, object_type=None, pq=None):
     # Here's an edge.  That subject and object only appear once in the input data:
     edge= {"subject":"PUBCHEM.COMPOUND:70701426","predicate":"biolink:affects","object":"NCBIGene:239",
@@ -116,3 +168,68 @@ def run_basic_tests(rc, descender, subject_type=None, object_type=None, pq=None)
     assert json.loads(node)["id"] == subject_id
     assert len(edges) == 1
 
+
+def test_node_fragment():
+    # Both node formats in db1 should come out the same when spliced into a response
+    node = {"id": "CHEBI:\"1\"", "name": "x", "categories": ["biolink:SmallMolecule"], "attributes": []}
+    as_json = json.dumps(node).encode()
+    as_fragment = create_node_fragment(node).encode()
+    for node_string in (as_json, as_fragment):
+        curie, fragment = node_fragment(node_string)
+        assert json.loads(curie) == node["id"]
+        assert json.loads(b"{" + fragment + b"}") == {node["id"]: {"name": "x", "categories": ["biolink:SmallMolecule"], "attributes": []}}
+
+
+def test_stream_missing():
+    # An edge whose node isn't in db1 (or that isn't in db4 itself) gets neither a knowledge edge nor a result
+    import numpy as np
+    query_graph = {"nodes": {"a": {"ids": ["CHEBI:1"]}, "b": {"categories": ["biolink:Gene"]}},
+                   "edges": {"e": {"subject": "a", "object": "b", "predicates": ["biolink:affects"]}}}
+    nodes = {1: b'{"id": "CHEBI:1"}', 2: b'{"id": "NCBIGene:2"}'}
+    edges = {i: json.dumps({"predicate": "biolink:affects"}).encode() for i in (10, 11, 12)}
+    del edges[12]
+    # Edge 11 goes to node 3, which is missing
+    forward = (np.array([1, 2, 3]), np.array([10, 11, 12]), np.array([1, 1, 1]), np.array([2, 3, 2]))
+    async def response():
+        # With the strings given, redis is never asked
+        rc = RedisConnection("localhost", 6379, "")
+        pieces = stream_response(query_graph, "e", "a", "b", forward, None, rc, strings=(nodes, edges))
+        return json.loads(b"".join([piece async for piece in pieces]))
+    message = asyncio.run(response())["message"]
+    assert list(message["knowledge_graph"]["edges"]) == ["knowledge_edge_0"]
+    assert [r["node_bindings"]["b"] for r in message["results"]] == [[{"id": "NCBIGene:2"}]]
+
+
+def test_query_graph_key():
+    # The response echoes the query graph, so only the same graph can share a cached response
+    query_graph = {"nodes": {"a": {"ids": ["CHEBI:1", "CHEBI:2"]}, "b": {"categories": ["biolink:Gene"]}},
+                   "edges": {"e": {"subject": "a", "object": "b", "predicates": ["biolink:affects"]}}}
+    same = {"edges": query_graph["edges"], "nodes": {"b": query_graph["nodes"]["b"], "a": query_graph["nodes"]["a"]}}
+    assert create_query_graph_key(same) == create_query_graph_key(query_graph)
+    reordered = {**query_graph, "nodes": {**query_graph["nodes"], "a": {"ids": ["CHEBI:2", "CHEBI:1"]}}}
+    assert create_query_graph_key(reordered) != create_query_graph_key(query_graph)
+    annotated = {**query_graph, "nodes": {**query_graph["nodes"], "a": {"ids": ["CHEBI:1", "CHEBI:2"], "name": "x"}}}
+    assert create_query_graph_key(annotated) != create_query_graph_key(query_graph)
+
+def test_cursor():
+    query_graph = {"nodes": {"a": {"ids": ["CHEBI:1", "CHEBI:2"]}, "b": {"categories": ["biolink:Gene"]}},
+                   "edges": {"e": {"subject": "a", "object": "b", "predicates": ["biolink:affects"]}}}
+    cursor = create_cursor(b"abc", query_graph, (3, 1000))
+    assert read_cursor(cursor, b"abc", query_graph) == (3, 1000)
+    # Not after a load, not for another query (the order of the ids matters), and not if it's been mangled
+    with pytest.raises(ValueError):
+        read_cursor(cursor, b"def", query_graph)
+    query_graph["nodes"]["a"]["ids"].reverse()
+    with pytest.raises(ValueError):
+        read_cursor(cursor, b"abc", query_graph)
+    with pytest.raises(ValueError):
+        read_cursor("nonsense", b"abc", query_graph)
+    # Nor if it's been made up to point before the start
+    for position in [(0, -5), (-1, 0)]:
+        with pytest.raises(ValueError):
+            read_cursor(create_cursor(b"abc", query_graph, position), b"abc", query_graph)
+    # A cursor is good for exactly the query graphs that share its cached page
+    query_graph["nodes"]["a"]["ids"].reverse()
+    same = {"edges": query_graph["edges"], "nodes": {"b": query_graph["nodes"]["b"], "a": query_graph["nodes"]["a"]}}
+    assert create_query_graph_key(same) == create_query_graph_key(query_graph)
+    assert read_cursor(cursor, b"abc", same) == (3, 1000)
@@ -97,6 +97,75 @@ def test_affects():
     print("How many results?",len(response.json()["message"]["results"]))
     assert response.status_code == 200
 
+def test_stream():
+    # The streamed response should be the same as the usual one
+    m = {
+      "message": {
+        "query_graph": {
+          "nodes": {
+            "subnode": {
+              "ids": [
+                "PUBCHEM.COMPOUND:70701426"
+              ]
+            },
+            "objnode": {
+              "categories": [
+                "biolink:Gene"
+              ]
+            }
+          },
+          "edges": {
+            "the_edge": {
+              "subject": "subnode",
+              "object": "objnode",
+              "predicates": [
+                "biolink:affects"
+              ]
+            }
+          }
+        }
+      }
+    }
+    response = client.post("/query", json=m)
+    streamed = client.post("/query", json=m, params={"stream": "true"})
+    assert streamed.status_code == 200
+    assert streamed.json() == response.json()
+
+def test_batch():
+    # Each response in a batch should be the same as asking for it on its own
+    queries = []
+    for curie in ["PUBCHEM.COMPOUND:70701426", "PUBCHEM.COMPOUND:60795", "PUBCHEM.COMPOUND:70701426"]:
+        queries.append({"message": {"query_graph": {
+            "nodes": {"subnode": {"ids": [curie]}, "objnode": {"categories": ["biolink:Gene"]}},
+            "edges": {"the_edge": {"subject": "subnode", "object": "objnode", "predicates": ["biolink:affects"]}}}}})
+    batch = client.post("/batch_query", json=queries)
+    assert batch.status_code == 200
+    assert batch.json() == [client.post("/query", json=query).json() for query in queries]
+
+def test_bad_cursor():
+    # A bad limit or cursor is the client's mistake, so it gets a 400 that says what's wrong, not a 500
+    m = {"message": {"query_graph": {
+        "nodes": {"subnode": {"ids": ["PUBCHEM.COMPOUND:70701426"]}, "objnode": {"categories": ["biolink:Gene"]}},
+        "edges": {"the_edge": {"subject": "subnode", "object": "objnode", "predicates": ["biolink:affects"]}}}}}
+    response = client.post("/query", json=m, params={"limit": -1})
+    assert response.status_code == 400
+    response = client.post("/query", json=m, params={"cursor": "nonsense"})
+    assert response.status_code == 400
+    response = client.post("/query", json=m, params={"limit": 1, "cursor": "nonsense"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Not a valid cursor"
+
+def test_count():
+    # /count should agree with /query, even when the ids overlap: PUBCHEM.COMPOUND:54687 is a subclass of CHEBI:87633,
+    # so its edges are found twice
+    for objnode in [{"categories": ["biolink:Gene"]}, {"ids": ["NCBIGene:3156", "NCBIGene:3157"]}]:
+        m = {"message": {"query_graph": {
+            "nodes": {"subnode": {"ids": ["CHEBI:87633", "PUBCHEM.COMPOUND:54687"]}, "objnode": objnode},
+            "edges": {"the_edge": {"subject": "subnode", "object": "objnode", "predicates": ["biolink:affects"]}}}}}
+        count = client.post("/count", json=m)
+        assert count.status_code == 200
+        assert count.json()["total"] == len(client.post("/query", json=m).json()["message"]["results"]) > 0
+
 def test_500():
     # This is giving a 500, seems like it's getting into the double ended query by mistake.
     m = {